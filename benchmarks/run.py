@@ -0,0 +1,221 @@
+"""
+Benchmark s3-ocr commands against a local stand-in for S3 and Textract
+
+    python benchmarks/run.py --pdfs 200 --markers 100 --pages 50
+
+Results are written as JSON, to standard output or to --output FILE.
+"""
+
+import click
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+from queue import Empty
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standin import (  # noqa: E402
+    BUCKET,
+    StandIn,
+    free_port,
+    populate_bucket,
+    serve,
+    wait_for_server,
+)
+
+BENCHMARKS = ("start", "dedupe", "index", "fetch", "text")
+
+
+def first_document():
+    return "docs/00/document-000000.pdf"
+
+
+def benchmark_args(name, params, tmpdir):
+    # Returns (arguments for s3-ocr, number of rows processed)
+    pdfs, markers = params["pdfs"], params["markers"]
+    if name == "start":
+        return ["start", BUCKET, "--all"], pdfs - markers
+    elif name == "dedupe":
+        return ["dedupe", BUCKET], markers
+    elif name == "index":
+        args = ["index", BUCKET, os.path.join(tmpdir, "index.db")]
+        args.extend(["--workers", str(params["workers"])])
+        if params["fast"]:
+            args.append("--fast")
+        return args, markers * params["pages"]
+    elif name == "fetch":
+        output = os.path.join(tmpdir, "combined.json")
+        return ["fetch", BUCKET, first_document(), "--combine", output], params["pages"]
+    elif name == "text":
+        return ["text", BUCKET, first_document()], params["pages"]
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes on Linux
+    if sys.platform == "darwin":
+        peak = peak // 1024
+    return peak
+
+
+def run_benchmark(name, params, endpoint_url, queue):
+    # Runs in a freshly spawned process that talks to the moto server over
+    # HTTP, so peak RSS covers just this command and not the bucket contents
+    from s3_ocr.cli import cli
+
+    standin = StandIn(latency=params["latency"], throttle=params["throttle"])
+    standin.install()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args, rows = benchmark_args(name, params, tmpdir)
+        rss_before = peak_rss_kb()
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+            devnull
+        ), contextlib.redirect_stderr(devnull):
+            cli.main(
+                args + ["--endpoint-url", endpoint_url],
+                prog_name="s3-ocr",
+                standalone_mode=False,
+            )
+        wall_time = time.perf_counter() - start
+        queue.put(
+            {
+                "benchmark": name,
+                # Temporary paths are left out, so results can be compared
+                "args": [
+                    os.path.relpath(arg, tmpdir) if arg.startswith(tmpdir) else arg
+                    for arg in args[:1] + args[2:]
+                ],
+                "wall_time": round(wall_time, 4),
+                "requests": dict(sorted(standin.requests.items())),
+                "throttled": dict(sorted(standin.throttled.items())),
+                "peak_rss_kb": peak_rss_kb(),
+                "setup_rss_kb": rss_before,
+                "rows": rows,
+                "rows_per_second": round(rows / wall_time, 2) if wall_time else None,
+            }
+        )
+
+
+def wait_for_result(process, queue):
+    "Returns the result put on the queue by process, or None if it exited first"
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                break
+    # It may have put its result on the queue just before exiting
+    try:
+        return queue.get(timeout=1)
+    except Empty:
+        return None
+
+
+def s3_ocr_version():
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        # importlib.metadata was added in Python 3.8
+        import pkg_resources
+
+        return pkg_resources.get_distribution("s3-ocr").version
+    return version("s3-ocr")
+
+
+@click.command()
+@click.argument("benchmarks", nargs=-1, type=click.Choice(BENCHMARKS))
+@click.option("--pdfs", default=200, help="Number of PDF files in the bucket")
+@click.option("--markers", default=100, help="Number of those PDFs that have been OCRd")
+@click.option("--pages", default=20, help="Pages in each OCRd document")
+@click.option("--lines-per-page", default=30, help="Lines of text on each page")
+@click.option(
+    "--blocks-per-file",
+    default=1000,
+    help="Blocks in each textract-output file - around 1MB per 1000",
+)
+@click.option(
+    "--latency", type=float, default=0.0, help="Seconds of latency for each request"
+)
+@click.option(
+    "--throttle",
+    type=float,
+    default=0.0,
+    help="Proportion of requests to reject with a throttling error",
+)
+@click.option("--workers", default=1, help="Passed to s3-ocr index --workers")
+@click.option("--fast", is_flag=True, help="Pass --fast to s3-ocr index")
+@click.option("-o", "--output", type=click.File("w"), default="-")
+def cli(benchmarks, output, **params):
+    "Run benchmarks - all of them, unless specific BENCHMARKS are listed"
+    if params["markers"] > params["pdfs"]:
+        raise click.ClickException("--markers cannot be greater than --pdfs")
+    import boto3
+
+    # spawn rather than fork, so the benchmark process starts out small
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    results = []
+    for name in benchmarks or BENCHMARKS:
+        # Each benchmark gets a fresh moto server in its own process
+        port = free_port()
+        endpoint_url = "http://127.0.0.1:{}".format(port)
+        server = context.Process(target=serve, args=(port,), daemon=True)
+        server.start()
+        try:
+            wait_for_server(port)
+            populate_bucket(
+                boto3.client(
+                    "s3",
+                    endpoint_url=endpoint_url,
+                    region_name="us-east-1",
+                    aws_access_key_id="testing",
+                    aws_secret_access_key="testing",
+                ),
+                pdfs=params["pdfs"],
+                markers=params["markers"] if name != "fetch" else 1,
+                pages=params["pages"],
+                lines_per_page=params["lines_per_page"],
+                blocks_per_file=params["blocks_per_file"],
+            )
+            process = context.Process(
+                target=run_benchmark, args=(name, params, endpoint_url, queue)
+            )
+            process.start()
+            # Read the result before join(), which could otherwise deadlock
+            # on a result that is too large for the pipe buffer
+            result = wait_for_result(process, queue)
+            process.join()
+        finally:
+            server.terminate()
+            server.join()
+        if process.exitcode != 0 or result is None:
+            raise click.ClickException("Benchmark {} failed".format(name))
+        click.echo(
+            "{benchmark}: {wall_time}s, {rows_per_second} rows/s".format(**result),
+            err=True,
+        )
+        results.append(result)
+    output.write(
+        json.dumps(
+            {
+                "s3_ocr_version": s3_ocr_version(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "params": params,
+                "results": results,
+            },
+            indent=2,
+        )
+        + "\n"
+    )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,258 @@
+"""
+Benchmark search queries against a synthetic 's3-ocr index' database
+
+    python benchmarks/search.py --pages 2000000 --database /tmp/search.db
+
+The database is generated the first time, then reused by later runs that
+pass the same --database. Results are written as JSON, to standard output
+or to --output FILE.
+"""
+
+import click
+import concurrent.futures
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite_utils
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from s3_ocr import SearchIndex  # noqa: E402
+from s3_ocr.cli import enable_compression  # noqa: E402
+from s3_ocr.compression import build_zdict  # noqa: E402
+
+VOCABULARY_SIZE = 50000
+
+
+def word(i):
+    # Short, pronounceable, unique word for each vocabulary index
+    consonants, vowels = "bcdfghjklmnprstvwz", "aeiou"
+    letters = []
+    while True:
+        i, c = divmod(i, len(consonants))
+        i, v = divmod(i, len(vowels))
+        letters.append(consonants[c] + vowels[v])
+        if not i:
+            return "".join(letters)
+
+
+def generate_pages(pages, words_per_page, pages_per_document, seed=0):
+    rnd = random.Random(seed)
+    vocabulary = [word(i) for i in range(VOCABULARY_SIZE)]
+    # Zipf-like weights, so a few words are very common and most are rare
+    cum_weights = list(
+        itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY_SIZE))
+    )
+    for i in range(pages):
+        document, page = divmod(i, pages_per_document)
+        folder = "folder-{:03d}/sub-{:02d}".format(document % 500, document % 7)
+        yield {
+            "path": "{}/document-{:08d}.pdf".format(folder, document),
+            "page": page + 1,
+            "folder": folder,
+            "text": " ".join(
+                rnd.choices(vocabulary, cum_weights=cum_weights, k=words_per_page)
+            ),
+        }
+
+
+def build_database(path, pages, words_per_page, pages_per_document, compress):
+    db = sqlite_utils.Database(path)
+    db["pages"].create(
+        {"path": str, "page": int, "folder": str, "text": str}, pk=("path", "page")
+    )
+    db["pages"].insert_all(
+        generate_pages(pages, words_per_page, pages_per_document), batch_size=10000
+    )
+    db["pages"].enable_fts(["text"], create_triggers=True)
+    if compress:
+        # The same conversion that 's3-ocr index --compress' applies
+        sample = [row[0] for row in db.execute("SELECT text FROM pages LIMIT 1000")]
+        enable_compression(db, build_zdict(sample))
+    db.execute("PRAGMA optimize")
+
+
+def queries():
+    # (name, query, search() keyword arguments)
+    return [
+        ("common word", word(0), {}),
+        ("mid-frequency word", word(500), {}),
+        ("rare word", word(VOCABULARY_SIZE - 10), {}),
+        ("two words", "{} {}".format(word(20), word(300)), {}),
+        ("phrase", '"{} {}"'.format(word(1), word(2)), {"raw": True}),
+        ("common word in folder", word(0), {"folder": "folder-007"}),
+        ("common word, page 50", word(0), {"offset": 50 * 20}),
+    ]
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+
+    def at(p):
+        return round(timings[min(int(len(timings) * p), len(timings) - 1)] * 1000, 3)
+
+    return {
+        "mean_ms": round(statistics.mean(timings) * 1000, 3),
+        "p50_ms": at(0.5),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+        "max_ms": round(timings[-1] * 1000, 3),
+    }
+
+
+def run_queries(index, query, kwargs, repeat, threads):
+    def timed(_):
+        start = time.perf_counter()
+        index.search(query, **kwargs)
+        return time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        start = time.perf_counter()
+        timings = list(executor.map(timed, range(repeat)))
+        wall_time = time.perf_counter() - start
+    result = percentiles(timings)
+    result["queries_per_second"] = round(repeat / wall_time, 1)
+    return result
+
+
+def time_page_text(path, repeat):
+    "Time reading the full text of randomly chosen pages"
+    index = SearchIndex(path)
+    keys = index.connection().execute("SELECT path, page FROM pages").fetchall()
+    rnd = random.Random(0)
+    timings = []
+    for path, page in rnd.choices(keys, k=repeat):
+        start = time.perf_counter()
+        index.page_text(path, page)
+        timings.append(time.perf_counter() - start)
+    index.close()
+    return percentiles(timings)
+
+
+def s3_ocr_version():
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        # importlib.metadata was added in Python 3.8
+        import pkg_resources
+
+        return pkg_resources.get_distribution("s3-ocr").version
+    return version("s3-ocr")
+
+
+@click.command()
+@click.option("--pages", default=100000, help="Number of pages in the index")
+@click.option("--words-per-page", default=250, help="Words of text on each page")
+@click.option("--pages-per-document", default=20, help="Pages in each document")
+@click.option(
+    "--database",
+    type=click.Path(dir_okay=False),
+    help="Database to create, or to reuse if it already exists",
+)
+@click.option(
+    "--compress",
+    is_flag=True,
+    help="Compress page text, like 's3-ocr index --compress'",
+)
+@click.option("--repeat", default=200, help="Times to run each query")
+@click.option(
+    "--threads",
+    multiple=True,
+    type=int,
+    default=(1, 4),
+    help="Number of threads running queries - can be used multiple times",
+)
+@click.option("--cache-size", default=128, help="cache_size for the cached runs")
+@click.option("-o", "--output", type=click.File("w"), default="-")
+def cli(
+    pages,
+    words_per_page,
+    pages_per_document,
+    database,
+    compress,
+    repeat,
+    threads,
+    cache_size,
+    output,
+):
+    "Benchmark SearchIndex query latency"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = database or os.path.join(tmpdir, "search.db")
+        build_seconds = None
+        if not os.path.exists(path):
+            click.echo("Building {} page index...".format(pages), err=True)
+            start = time.perf_counter()
+            build_database(path, pages, words_per_page, pages_per_document, compress)
+            build_seconds = round(time.perf_counter() - start, 2)
+        results = []
+        for name, query, kwargs in queries():
+            # The first query on a fresh connection includes opening the file
+            index = SearchIndex(path)
+            start = time.perf_counter()
+            matches = index.count(
+                query, folder=kwargs.get("folder"), raw=kwargs.get("raw", False)
+            )
+            first_ms = round((time.perf_counter() - start) * 1000, 3)
+            result = {
+                "query": name,
+                "matches": matches,
+                "first_query_ms": first_ms,
+                "uncached": {},
+                "cached": {},
+            }
+            for thread_count in threads:
+                result["uncached"][thread_count] = run_queries(
+                    index, query, kwargs, repeat, thread_count
+                )
+            index.close()
+            cached_index = SearchIndex(path, cache_size=cache_size)
+            for thread_count in threads:
+                result["cached"][thread_count] = run_queries(
+                    cached_index, query, kwargs, repeat, thread_count
+                )
+            cached_index.close()
+            click.echo(
+                "{}: {} matches, p50 {}ms uncached, {}ms cached".format(
+                    name,
+                    matches,
+                    result["uncached"][threads[0]]["p50_ms"],
+                    result["cached"][threads[0]]["p50_ms"],
+                ),
+                err=True,
+            )
+            results.append(result)
+        page_text = time_page_text(path, repeat)
+        click.echo("page_text: p50 {}ms".format(page_text["p50_ms"]), err=True)
+        output.write(
+            json.dumps(
+                {
+                    "s3_ocr_version": s3_ocr_version(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "params": {
+                        "pages": sqlite_utils.Database(path)["pages"].count,
+                        "database_bytes": os.path.getsize(path),
+                        "build_seconds": build_seconds,
+                        "repeat": repeat,
+                        "cache_size": cache_size,
+                        "compressed": bool(
+                            sqlite_utils.Database(path)["s3_ocr_settings"].exists()
+                        ),
+                    },
+                    "results": results,
+                    "page_text": page_text,
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+
+
+if __name__ == "__main__":
+    cli()
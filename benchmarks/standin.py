@@ -0,0 +1,218 @@
+"""
+A local stand-in for S3 and Textract, built on moto's server mode, with
+configurable latency and throttling - plus helpers for filling it with
+synthetic data.
+"""
+
+from botocore.awsrequest import AWSResponse
+import boto3
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+BUCKET = "benchmark-bucket"
+
+S3_THROTTLE_BODY = (
+    b"<Error><Code>SlowDown</Code>"
+    b"<Message>Please reduce your request rate.</Message></Error>"
+)
+JSON_THROTTLE_BODY = b'{"__type": "ThrottlingException", "message": "Rate exceeded"}'
+
+
+def free_port():
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(port):
+    """
+    Run a moto server on port until this process is terminated. Running it
+    in its own process keeps the synthetic bucket out of the memory use of
+    the command that is being benchmarked.
+    """
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    ThreadedMotoServer(port=port, verbose=False).start()
+    threading.Event().wait()
+
+
+def wait_for_server(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class _RawBody:
+    def __init__(self, body):
+        self._body = body
+
+    def stream(self, **kwargs):
+        yield self._body
+
+
+class StandIn:
+    """
+    Hooks in to every boto3 client created after install() is called,
+    adding latency to each request and rejecting a proportion of them
+    with a throttling error. Also counts requests per operation.
+
+    This runs in the process that makes the requests, not the moto server.
+    Clients that were created before install() was called are not affected.
+    """
+
+    def __init__(self, latency=0.0, throttle=0.0, seed=0):
+        self.latency = latency
+        self.throttle = throttle
+        self.requests = collections.Counter()
+        self.throttled = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def install(self):
+        os.environ.update(
+            {
+                "AWS_ACCESS_KEY_ID": "testing",
+                "AWS_SECRET_ACCESS_KEY": "testing",
+                "AWS_SESSION_TOKEN": "testing",
+                "AWS_DEFAULT_REGION": "us-east-1",
+            }
+        )
+        boto3.setup_default_session()
+        # register_first() so these run before moto's own handler
+        boto3.DEFAULT_SESSION.events.register_first("before-send", self._before_send)
+
+    def _before_send(self, request, event_name, **kwargs):
+        operation = event_name.split(".", 1)[1]
+        with self._lock:
+            self.requests[operation] += 1
+            throttle = self._random.random() < self.throttle
+            if throttle:
+                self.throttled[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttle:
+            if operation.startswith("s3."):
+                return AWSResponse(request.url, 503, {}, _RawBody(S3_THROTTLE_BODY))
+            return AWSResponse(
+                request.url,
+                400,
+                {"Content-Type": "application/x-amz-json-1.1"},
+                _RawBody(JSON_THROTTLE_BODY),
+            )
+        return None
+
+
+def etag(content):
+    return '"{}"'.format(hashlib.md5(content).hexdigest())
+
+
+def textract_blocks(pages, lines_per_page, words_per_line=6, seed=0):
+    "Generate blocks that look like GetDocumentTextDetection output"
+    rnd = random.Random(seed)
+    for page in range(1, pages + 1):
+        yield _block("PAGE", page, rnd, None)
+        for line_number in range(lines_per_page):
+            words = [
+                "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(6))
+                for _ in range(words_per_line)
+            ]
+            yield _block("LINE", page, rnd, " ".join(words))
+            for word in words:
+                yield _block("WORD", page, rnd, word)
+
+
+def _block(block_type, page, rnd, text):
+    left, top = rnd.random() * 0.5, rnd.random() * 0.9
+    width, height = rnd.random() * 0.5, 0.02
+    block = {
+        "BlockType": block_type,
+        "Confidence": 90 + rnd.random() * 10,
+        "Geometry": {
+            "BoundingBox": {
+                "Width": width,
+                "Height": height,
+                "Left": left,
+                "Top": top,
+            },
+            "Polygon": [
+                {"X": left, "Y": top},
+                {"X": left + width, "Y": top},
+                {"X": left + width, "Y": top + height},
+                {"X": left, "Y": top + height},
+            ],
+        },
+        "Id": "{:032x}".format(rnd.getrandbits(128)),
+        "Page": page,
+        "Relationships": [
+            {"Type": "CHILD", "Ids": ["{:032x}".format(rnd.getrandbits(128))]}
+        ],
+    }
+    if text is not None:
+        block["Text"] = text
+        block["TextType"] = "PRINTED"
+    return block
+
+
+def populate_bucket(
+    s3,
+    pdfs,
+    markers,
+    pages,
+    lines_per_page,
+    blocks_per_file=1000,
+    pdf_size=1024,
+    bucket=BUCKET,
+):
+    """
+    Create a bucket with pdfs PDF files, the first markers of which have a
+    .s3-ocr.json file and Textract output with the specified number of pages.
+
+    Returns the total number of pages of OCR output.
+    """
+    s3.create_bucket(Bucket=bucket)
+    # Every document shares the same generated output, to save time
+    blocks = list(textract_blocks(pages, lines_per_page))
+    output_files = [
+        json.dumps(
+            {
+                "DocumentMetadata": {"Pages": pages},
+                "JobStatus": "SUCCEEDED",
+                "Blocks": blocks[i : i + blocks_per_file],
+            }
+        ).encode("utf8")
+        for i in range(0, len(blocks), blocks_per_file)
+    ]
+    for i in range(pdfs):
+        key = "docs/{:02d}/document-{:06d}.pdf".format(i % 100, i)
+        # Pad with the key so every PDF has a distinct ETag
+        content = key.encode("utf8").ljust(pdf_size, b"\0")
+        s3.put_object(Bucket=bucket, Key=key, Body=content)
+        if i < markers:
+            job_id = hashlib.sha256(key.encode("utf8")).hexdigest()
+            s3.put_object(
+                Bucket=bucket,
+                Key=key + ".s3-ocr.json",
+                Body=json.dumps({"job_id": job_id, "etag": etag(content)}),
+            )
+            for number, body in enumerate(output_files, start=1):
+                s3.put_object(
+                    Bucket=bucket,
+                    Key="textract-output/{}/{}".format(job_id, number),
+                    Body=body,
+                )
+    return markers * pages
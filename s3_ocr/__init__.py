@@ -0,0 +1,3 @@
+from .search import SearchIndex
+
+__all__ = ["SearchIndex"]
@@ -1,13 +1,58 @@
 import click
+import collections
+import concurrent.futures
 import configparser
+import contextlib
 import boto3
+import cProfile
 import io
 import json
+import os
+import shutil
+import sqlite3
 import sqlite_utils
+import struct
+import tempfile
+import threading
 import time
+from .compression import (
+    SETTINGS_TABLE,
+    TextCodec,
+    build_zdict,
+    create_function,
+    register_text_function,
+)
+from .search import SearchIndex
+from .stats import Stats
 
 S3_OCR_JSON = ".s3-ocr.json"
 
+# start --split-pages only downloads PDFs at least this large to count pages
+SPLIT_MIN_BYTES = 10 * 1024 * 1024
+
+# Page-range chunks created by start --split-pages are uploaded here
+CHUNKS_PREFIX = "s3-ocr-chunks/"
+
+# Sort keys and directions for start --order
+START_ORDERS = {
+    "smallest": (lambda item: item["Size"], False),
+    "largest": (lambda item: item["Size"], True),
+    "oldest": (lambda item: item["LastModified"], False),
+    "newest": (lambda item: item["LastModified"], True),
+}
+
+# Connection settings used by index --fast
+FAST_PRAGMAS = (
+    ("synchronous", "NORMAL"),
+    # Negative cache_size is in KiB, so this is 256MB
+    ("cache_size", -256 * 1024),
+    ("temp_store", "MEMORY"),
+    ("mmap_size", 1024 * 1024 * 1024),
+)
+
+# Optional tables populated by index --lines and --words
+LAYOUT_TABLES = {"lines": "LINE", "words": "WORD"}
+
 
 def strip_ocr_json(key):
     assert key.endswith(S3_OCR_JSON)
@@ -45,8 +90,44 @@ def common_boto3_options(fn):
     return fn
 
 
-def make_client(
-    service, access_key, secret_key, session_token, endpoint_url, auth, region_name=None
+def make_client(service, **boto_options):
+    return instrument(boto3.client(service, **client_kwargs(**boto_options)))
+
+
+# Stats for worker threads, which cannot see the click context
+_thread_stats = threading.local()
+
+
+def current_stats():
+    "Returns the Stats object for this run, or None if stats are not enabled"
+    if "stats" in _shard:
+        # This is a worker process for index --workers
+        return _shard["stats"]
+    if hasattr(_thread_stats, "stats"):
+        # This is a worker thread started by ordered_map()
+        return _thread_stats.stats
+    ctx = click.get_current_context(silent=True)
+    if ctx is None:
+        return None
+    return (ctx.find_root().obj or {}).get("stats")
+
+
+def instrument(client):
+    stats = current_stats()
+    if stats is not None:
+        stats.instrument(client)
+    return client
+
+
+def timer(operation):
+    stats = current_stats()
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.timer(operation)
+
+
+def client_kwargs(
+    access_key, secret_key, session_token, endpoint_url, auth, region_name=None
 ):
     if auth:
         if access_key or secret_key or session_token:
@@ -82,12 +163,28 @@ def make_client(
         kwargs["endpoint_url"] = endpoint_url
     if region_name:
         kwargs["region_name"] = region_name
-    return boto3.client(service, **kwargs)
+    return kwargs
 
 
 @click.group()
 @click.version_option()
-def cli():
+@click.option(
+    "--stats",
+    is_flag=True,
+    help="Show a summary of requests and timings when the command finishes",
+)
+@click.option(
+    "--stats-json",
+    type=click.File("w"),
+    help="Write request and timing statistics as JSON to this file",
+)
+@click.option(
+    "--profile",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    help="Run with cProfile and write profile data to this file",
+)
+@click.pass_context
+def cli(ctx, stats, stats_json, profile):
     """
     Tools for running OCR against files stored in S3
 
@@ -95,6 +192,31 @@ def cli():
 
     Changelog: https://github.com/simonw/s3-ocr/releases
     """
+    ctx.ensure_object(dict)
+    if stats or stats_json:
+        ctx.obj["stats"] = Stats()
+        start = time.perf_counter()
+
+        def report():
+            collected = ctx.obj["stats"]
+            if stats:
+                click.echo(collected.summary(), err=True)
+            if stats_json:
+                data = collected.to_dict()
+                data["command"] = ctx.invoked_subcommand
+                data["wall_seconds"] = time.perf_counter() - start
+                stats_json.write(json.dumps(data, indent=2) + "\n")
+
+        ctx.call_on_close(report)
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def write_profile():
+            profiler.disable()
+            profiler.dump_stats(profile)
+
+        ctx.call_on_close(write_profile)
 
 
 @cli.command()
@@ -106,8 +228,56 @@ def cli():
     "--dry-run", is_flag=True, help="Show what this would do, but don't actually do it"
 )
 @click.option("--no-retry", is_flag=True, help="Don't retry failed requests")
+@click.option(
+    "--split-pages",
+    type=click.IntRange(min=1),
+    help="Split PDFs with more than this many pages into a separate job per range",
+)
+@click.option(
+    "--split-min-bytes",
+    type=click.IntRange(min=0),
+    default=SPLIT_MIN_BYTES,
+    show_default=True,
+    help="Only download PDFs at least this large to check if they need splitting",
+)
+@click.option(
+    "--order",
+    type=click.Choice(list(START_ORDERS)),
+    help="Order in which to submit PDFs, based on their size or last modified date",
+)
+@click.option(
+    "priority_prefixes",
+    "--priority-prefix",
+    multiple=True,
+    help="Submit PDFs within this prefix before any others - can be used multiple times",
+)
+@click.option(
+    "--max-in-flight",
+    type=click.IntRange(min=1),
+    help="Wait for jobs to finish rather than have more than this many running",
+)
+@click.option(
+    "--max-bytes-in-flight",
+    type=click.IntRange(min=1),
+    help="Wait for jobs to finish rather than have PDFs totalling more than this "
+    "many bytes being processed",
+)
 @common_boto3_options
-def start(bucket, keys, all, prefix, dry_run, no_retry, **boto_options):
+def start(
+    bucket,
+    keys,
+    all,
+    prefix,
+    dry_run,
+    no_retry,
+    split_pages,
+    split_min_bytes,
+    order,
+    priority_prefixes,
+    max_in_flight,
+    max_bytes_in_flight,
+    **boto_options,
+):
     """
     Start OCR tasks for PDF files in an S3 bucket
 
@@ -120,6 +290,22 @@ def start(bucket, keys, all, prefix, dry_run, no_retry, **boto_options):
     To process every .pdf in the PUBLIC/ folder:
 
         s3-ocr start name-of-bucket --prefix PUBLIC/
+
+    To split PDFs with more than 500 pages into 500 page chunks, each
+    processed by its own OCR job:
+
+        s3-ocr start name-of-bucket --all --split-pages 500
+
+    Only PDFs of at least --split-min-bytes are downloaded to count their
+    pages - smaller PDFs are submitted as they are.
+
+    To submit the smallest PDFs first:
+
+        s3-ocr start name-of-bucket --all --order smallest
+
+    Add --priority-prefix urgent/ to submit PDFs in the urgent/ folder before
+    any others. Use --max-in-flight 20 to wait for running jobs to finish rather than
+    have more than 20 jobs running at once.
     """
     s3 = make_client("s3", **boto_options)
     bucket_region = s3.get_bucket_location(Bucket=bucket)["LocationConstraint"]
@@ -149,59 +335,195 @@ def start(bucket, keys, all, prefix, dry_run, no_retry, **boto_options):
         for item in items
         if item["Key"].endswith(S3_OCR_JSON)
     ]
-    pdf_items = [item for item in items if item["Key"].endswith(".pdf")]
+    pdf_items = [
+        item
+        for item in items
+        if item["Key"].endswith(".pdf") and not item["Key"].startswith(CHUNKS_PREFIX)
+    ]
     click.echo(
         "Found {} files with {} out of {} PDFs".format(
             len(keys_with_s3_ocr_files), S3_OCR_JSON, len(pdf_items)
         )
     )
+    items = schedule(
+        [item for item in pdf_items if item["Key"] not in keys_with_s3_ocr_files],
+        order,
+        priority_prefixes,
+    )
+
+    def may_split(item):
+        return split_pages and item["Size"] >= split_min_bytes
+
     if dry_run:
-        items = [
-            item for item in pdf_items if item["Key"] not in keys_with_s3_ocr_files
-        ]
         click.echo("Would start {} tasks for these keys:".format(len(items)))
         for item in items:
-            click.echo(item["Key"])
+            if may_split(item):
+                click.echo(
+                    "{} (split if it has more than {} pages)".format(
+                        item["Key"], split_pages
+                    )
+                )
+            else:
+                click.echo(item["Key"])
         return
-    for item in pdf_items:
+    if split_pages:
+        try:
+            import pypdf
+        except ImportError:
+            raise click.ClickException(
+                "--split-pages requires pypdf: pip install 's3-ocr[split]'"
+            )
+    # Maps job IDs started by this command that may still be running to
+    # the number of bytes they are processing
+    in_flight = {}
+    for item in items:
         key = item["Key"]
-        if key not in keys_with_s3_ocr_files:
-            sleep = 1
-            while True:
-                try:
-                    response = start_document_text_extraction(
-                        textract,
-                        DocumentLocation={
-                            "S3Object": {
-                                "Bucket": bucket,
-                                "Name": key,
-                            }
-                        },
-                        OutputConfig={
-                            "S3Bucket": bucket,
-                            "S3Prefix": "textract-output",
-                        },
-                    )
-                    break
-                except textract.exceptions.LimitExceededException as ex:
-                    if no_retry:
-                        raise click.ClickException(str(ex))
-                    click.echo("{} - retrying...".format(str(ex)))
-                    time.sleep(sleep)
-                    if sleep < 8:
-                        sleep *= 2
+        if may_split(item):
+            chunks = split_pdf(s3, bucket, key, split_pages, pypdf)
+        else:
+            chunks = [(key, 0)]
+        started = []
+        for chunk_key, offset in chunks:
+            size = item["Size"] / len(chunks)
+            if max_in_flight or max_bytes_in_flight:
+                wait_for_jobs(
+                    textract, in_flight, size, max_in_flight, max_bytes_in_flight
+                )
+            response = start_job(textract, bucket, chunk_key, no_retry)
             job_id = response.get("JobId")
-            if job_id:
+            if not job_id:
+                click.echo(f"Failed to start OCR for {chunk_key}")
+                click.echo(response)
+                break
+            if chunk_key == key:
                 click.echo(f"Starting OCR for {key}, Job ID: {job_id}")
-                # Write a .s3-ocr.json file for this item
-                s3.put_object(
-                    Bucket=bucket,
-                    Key=f"{key}.s3-ocr.json",
-                    Body=json.dumps({"job_id": job_id, "etag": item["ETag"]}),
-                )
             else:
-                click.echo(f"Failed to start OCR for {key}")
-                click.echo(response)
+                click.echo(
+                    f"Starting OCR for {key} from page {offset + 1}, Job ID: {job_id}"
+                )
+            in_flight[job_id] = size
+            started.append({"job_id": job_id, "offset": offset})
+        else:
+            # Write a .s3-ocr.json file for this item
+            marker = {"job_id": started[0]["job_id"], "etag": item["ETag"]}
+            if len(started) > 1:
+                marker["chunks"] = started
+            s3.put_object(
+                Bucket=bucket,
+                Key=f"{key}.s3-ocr.json",
+                Body=json.dumps(marker),
+            )
+
+
+def schedule(items, order=None, priority_prefixes=()):
+    "Sort PDFs to be submitted by start, for --order and --priority-prefix"
+    if order:
+        sort_key, reverse = START_ORDERS[order]
+        items = sorted(items, key=sort_key, reverse=reverse)
+    if priority_prefixes:
+
+        def priority(item):
+            for i, priority_prefix in enumerate(priority_prefixes):
+                if item["Key"].startswith(priority_prefix):
+                    return i
+            return len(priority_prefixes)
+
+        # Python's sort is stable, so --order still applies within each prefix
+        items = sorted(items, key=priority)
+    return items
+
+
+def wait_for_jobs(textract, in_flight, size, max_in_flight, max_bytes_in_flight):
+    """
+    Wait until a job processing size bytes can be started without going over
+    max_in_flight jobs or max_bytes_in_flight bytes, removing jobs from the
+    in_flight dictionary as they finish. A job that is too big on its own is
+    started once nothing else is running.
+    """
+
+    def too_busy():
+        if not in_flight:
+            return False
+        if max_in_flight and len(in_flight) >= max_in_flight:
+            return True
+        return bool(
+            max_bytes_in_flight and sum(in_flight.values()) + size > max_bytes_in_flight
+        )
+
+    sleep = 1
+    while too_busy():
+        for job_id in list(in_flight):
+            if get_job_status(textract, job_id) != "IN_PROGRESS":
+                del in_flight[job_id]
+        if too_busy():
+            if sleep == 1:
+                click.echo(
+                    "Waiting for some of {} running jobs to finish...".format(
+                        len(in_flight)
+                    )
+                )
+            time.sleep(sleep)
+            if sleep < 8:
+                sleep *= 2
+
+
+def start_job(textract, bucket, key, no_retry):
+    sleep = 1
+    while True:
+        try:
+            return start_document_text_extraction(
+                textract,
+                DocumentLocation={
+                    "S3Object": {
+                        "Bucket": bucket,
+                        "Name": key,
+                    }
+                },
+                OutputConfig={
+                    "S3Bucket": bucket,
+                    "S3Prefix": "textract-output",
+                },
+            )
+        except textract.exceptions.LimitExceededException as ex:
+            if no_retry:
+                raise click.ClickException(str(ex))
+            click.echo("{} - retrying...".format(str(ex)))
+            time.sleep(sleep)
+            if sleep < 8:
+                sleep *= 2
+
+
+def split_pdf(s3, bucket, key, pages_per_chunk, pypdf):
+    """
+    Upload a PDF with more than pages_per_chunk pages as a set of smaller
+    PDFs, each covering a range of pages. Returns a list of (key, offset)
+    pairs, where offset is the number of pages that come before that chunk.
+    """
+    with tempfile.TemporaryFile() as fp:
+        s3.download_fileobj(bucket, key, fp)
+        fp.seek(0)
+        try:
+            reader = pypdf.PdfReader(fp)
+            page_count = len(reader.pages)
+        except pypdf.errors.PdfReadError:
+            # Leave it to Textract to decide what to do with this file
+            return [(key, 0)]
+        if page_count <= pages_per_chunk:
+            return [(key, 0)]
+        chunks = []
+        for offset in range(0, page_count, pages_per_chunk):
+            last = min(offset + pages_per_chunk, page_count)
+            writer = pypdf.PdfWriter()
+            for page in reader.pages[offset:last]:
+                writer.add_page(page)
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            chunk_key = "{}{}/pages-{:06d}-{:06d}.pdf".format(
+                CHUNKS_PREFIX, key, offset + 1, last
+            )
+            s3.put_object(Bucket=bucket, Key=chunk_key, Body=buffer.getvalue())
+            chunks.append((chunk_key, offset))
+        return chunks
 
 
 @cli.command()
@@ -232,12 +554,15 @@ def dedupe(bucket, dry_run, **boto_options):
         for ocr_json_key, etag, key in s3_ocr_to_fetch:
             response = s3.get_object(Bucket=bucket, Key=ocr_json_key)
             data = json.loads(response["Body"].read())
-            yield {
+            row = {
                 "key": key,
                 "job_id": data["job_id"],
                 "etag": data["etag"],
                 "s3_ocr_etag": response["ETag"],
             }
+            if "chunks" in data:
+                row["chunks"] = data["chunks"]
+            yield row
 
     jobs_by_etag = {}
     with click.progressbar(
@@ -253,7 +578,9 @@ def dedupe(bucket, dry_run, **boto_options):
     not_yet_ocrd_keys = [
         item
         for item in items
-        if item["Key"].endswith(".pdf") and item["Key"] not in keys_that_have_been_done
+        if item["Key"].endswith(".pdf")
+        and item["Key"] not in keys_that_have_been_done
+        and not item["Key"].startswith(CHUNKS_PREFIX)
     ]
 
     # Which of these are dupes?
@@ -272,6 +599,8 @@ def dedupe(bucket, dry_run, **boto_options):
         ) as pairs:
             for key, details in pairs:
                 body = {"job_id": details["job_id"], "etag": details["etag"]}
+                if "chunks" in details:
+                    body["chunks"] = details["chunks"]
                 s3.put_object(
                     Bucket=bucket,
                     Key=f"{key}.s3-ocr.json",
@@ -296,9 +625,29 @@ def status(bucket, **boto_options):
         for item in items
         if item["Key"].startswith("textract-output")
     }
+    # A document split with --split-pages is only complete once every one of
+    # its chunks has output - this needs the job IDs from its .s3-ocr.json
+    split_keys = {
+        item["Key"][len(CHUNKS_PREFIX) :].rsplit("/", 1)[0]
+        for item in items
+        if item["Key"].startswith(CHUNKS_PREFIX)
+    }
+    chunk_job_ids = set()
+    completed_split = 0
+    for key in keys_with_s3_ocr_files:
+        if key not in split_keys:
+            continue
+        data = json.loads(
+            s3.get_object(Bucket=bucket, Key=key + S3_OCR_JSON)["Body"].read()
+        )
+        job_ids = {job_id for job_id, _ in marker_chunks(data)}
+        chunk_job_ids.update(job_ids)
+        if job_ids <= completed_job_ids:
+            completed_split += 1
     click.echo(
         "{} complete out of {} jobs".format(
-            len(completed_job_ids), len(keys_with_s3_ocr_files)
+            len(completed_job_ids - chunk_job_ids) + completed_split,
+            len(keys_with_s3_ocr_files),
         )
     )
 
@@ -346,50 +695,32 @@ def fetch(bucket, key, combine, **boto_options):
         s3-ocr fetch name-of-bucket path/to/key.pdf --combine output.json
 
     Use "--output -" to print the combined JSON to standard output instead.
+
+    For documents that were split using start --split-pages the page numbers
+    in every file are adjusted to count from the start of the document.
     """
     s3 = make_client("s3", **boto_options)
-
-    items = list(paginate(s3, "list_objects_v2", "Contents", Bucket=bucket, Prefix=key))
-    keys_with_s3_ocr_files = [
-        strip_ocr_json(item["Key"])
-        for item in items
-        if item["Key"].endswith(S3_OCR_JSON)
-    ]
-    if not keys_with_s3_ocr_files:
-        raise click.ClickException("Key could not be found in bucket: {}".format(key))
-    # Read that file to find the job ID
-    try:
-        job_id = json.loads(
-            s3.get_object(Bucket=bucket, Key=keys_with_s3_ocr_files[0] + S3_OCR_JSON)[
-                "Body"
-            ].read()
-        )["job_id"]
-    except Exception as e:
-        raise click.ClickException("Could not find job_id for key")
-    result_items = [
-        item
-        for item in paginate(
-            s3,
-            "list_objects_v2",
-            "Contents",
-            Bucket=bucket,
-            Prefix="textract-output/{}".format(job_id),
-        )
-        if ".s3_access_check" not in item["Key"]
-    ]
+    result_items = job_output_items(s3, bucket, key)
     if not combine:
-        for item in result_items:
+        for item, offset in result_items:
             filename = (
                 item["Key"].replace("textract-output/", "").replace("/", "-") + ".json"
             )
-            s3.download_file(bucket, item["Key"], filename)
+            if not offset:
+                s3.download_file(bucket, item["Key"], filename)
+                continue
+            # Chunks of a document split with --split-pages are saved with
+            # page numbers counting from the start of the whole document
+            data = json.loads(
+                s3.get_object(Bucket=bucket, Key=item["Key"])["Body"].read()
+            )
+            offset_pages(data["Blocks"], offset)
+            with open(filename, "w") as fp:
+                json.dump(data, fp)
     else:
         combined = []
-        for item in result_items:
-            blocks = json.loads(
-                s3.get_object(Bucket=bucket, Key=item["Key"])["Body"].read()
-            )["Blocks"]
-            combined.extend(blocks)
+        for item, offset in result_items:
+            combined.extend(offset_pages(fetch_blocks(s3, bucket, item), offset))
         combine.write(json.dumps({"Blocks": combined}))
 
 
@@ -404,22 +735,184 @@ def text(bucket, key, divider, **boto_options):
 
         s3-ocr text name-of-bucket path/to/key.pdf
     """
-    output = io.StringIO()
-    fetch.callback(bucket, key, combine=output, **boto_options)
-    output.seek(0)
-    blocks = json.loads(output.getvalue())["Blocks"]
-    current_page = None
-    for block in blocks:
-        if block["BlockType"] == "LINE":
-            page = block["Page"]
-            if current_page is not None:
-                if page != current_page:
-                    if divider:
-                        click.echo("\n----\n")
-                    else:
-                        click.echo("\n")
-            current_page = page
-            click.echo(block["Text"])
+    s3 = make_client("s3", **boto_options)
+    pages = {}
+    for item, offset in job_output_items(s3, bucket, key):
+        assemble_pages(fetch_blocks(s3, bucket, item), pages, offset=offset)
+    separator = "\n----\n\n" if divider else "\n\n"
+    # One write per page, rather than one per line
+    for i, page_number in enumerate(sorted(pages)):
+        click.echo(
+            (separator if i else "") + "\n".join(pages[page_number]) + "\n", nl=False
+        )
+
+
+@cli.command()
+@click.argument("bucket")
+@click.argument("keys", nargs=-1)
+@click.option("--all", is_flag=True, help="Export all OCRd files in the bucket")
+@click.option("--prefix", help="Export all OCRd files within this prefix")
+@click.option(
+    "format_",
+    "--format",
+    type=click.Choice(("text", "jsonl")),
+    default="text",
+    help="Output format",
+)
+@click.option("--divider", is_flag=True, help="Add ---- between pages")
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="File to write to, defaults to standard output",
+)
+@click.option(
+    "-d",
+    "--database",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+    help="Read text from a database created by 's3-ocr index' instead of S3",
+)
+@click.option(
+    "-c",
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=8,
+    help="Number of documents to fetch from S3 at once",
+)
+@common_boto3_options
+def export(
+    bucket,
+    keys,
+    all,
+    prefix,
+    format_,
+    divider,
+    output,
+    database,
+    concurrency,
+    **boto_options,
+):
+    """
+    Export the text of many OCRd PDF files at once
+
+        s3-ocr export name-of-bucket path/to/one.pdf path/to/two.pdf
+
+    To export every OCRd file in the PUBLIC/ folder as newline-delimited
+    JSON, with one {"path": ..., "page": ..., "text": ...} object per page:
+
+        s3-ocr export name-of-bucket --prefix PUBLIC/ --format jsonl
+
+    Use --database to read from an existing 's3-ocr index' database.
+    """
+    if not keys and not all and not prefix:
+        raise click.ClickException(
+            "Specify keys, --prefix or use --all to export all OCRd files"
+        )
+    if database:
+        documents = _export_documents_from_database(database, keys, prefix)
+    else:
+        documents = _export_documents_from_s3(
+            bucket, keys, prefix, concurrency, **boto_options
+        )
+    page_separator = "\n\n----\n\n" if divider else "\n\n\n"
+    for path, pages in documents:
+        if format_ == "jsonl":
+            for page, text in pages:
+                output.write(
+                    json.dumps({"path": path, "page": page, "text": text}) + "\n"
+                )
+        else:
+            output.write("==> {} <==\n".format(path))
+            # Like the text command, pages with no text are left out
+            output.write(page_separator.join(text for _, text in pages if text))
+            output.write("\n\n")
+
+
+def _export_documents_from_s3(bucket, keys, prefix, concurrency, **boto_options):
+    # Yields (path, [(page, text), ...]) for each document, in order
+    s3 = make_client("s3", **boto_options)
+    if not keys:
+        kwargs = dict(Bucket=bucket)
+        if prefix:
+            kwargs["Prefix"] = prefix
+        keys = [
+            strip_ocr_json(item["Key"])
+            for item in paginate(s3, "list_objects_v2", "Contents", **kwargs)
+            if item["Key"].endswith(S3_OCR_JSON)
+        ]
+
+    def _fetch(key):
+        try:
+            response = s3.get_object(Bucket=bucket, Key=key + S3_OCR_JSON)
+        except s3.exceptions.NoSuchKey:
+            return key, None
+        chunks = marker_chunks(json.loads(response["Body"].read()))
+        job_items = chunk_output_items(s3, bucket, chunks)
+        pages, _ = fetch_job_pages(s3, bucket, job_items)
+        return key, [(number, "\n".join(pages[number])) for number in sorted(pages)]
+
+    for key, pages in ordered_map(_fetch, keys, concurrency):
+        if pages is None:
+            click.echo("No OCR results for key: {}".format(key), err=True)
+            continue
+        yield key, pages
+
+
+def _export_documents_from_database(database, keys, prefix):
+    db = sqlite_utils.Database(database)
+    register_text_function(db.conn)
+    if keys:
+        for key in keys:
+            pages = [
+                (row["page"], row["text"])
+                for row in db.query(
+                    "SELECT page, s3_ocr_text(text) AS text FROM pages "
+                    "WHERE path = ? ORDER BY page",
+                    [key],
+                )
+            ]
+            if not pages:
+                click.echo("No OCR results for key: {}".format(key), err=True)
+                continue
+            yield key, pages
+        return
+    sql = "SELECT path, page, s3_ocr_text(text) AS text FROM pages"
+    params = []
+    if prefix:
+        sql += " WHERE substr(path, 1, ?) = ?"
+        params = [len(prefix), prefix]
+    sql += " ORDER BY path, page"
+    # Rows are streamed from SQLite, one document at a time
+    path, pages = None, []
+    for row in db.query(sql, params):
+        if row["path"] != path:
+            if pages:
+                yield path, pages
+            path, pages = row["path"], []
+        pages.append((row["page"], row["text"]))
+    if pages:
+        yield path, pages
+
+
+def ordered_map(fn, items, concurrency):
+    # Like executor.map() but only keeps a limited number of results in
+    # memory, while still yielding them in the order of the input
+    stats = current_stats()
+
+    def call(item):
+        # Worker threads record their timings against the same Stats
+        _thread_stats.stats = stats
+        return fn(item)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(call, item))
+            if len(pending) >= concurrency * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 @cli.command()
@@ -429,31 +922,299 @@ def text(bucket, key, divider, **boto_options):
     type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
     required=True,
 )
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes to use for populating the pages table",
+)
+@click.option(
+    "--fast",
+    is_flag=True,
+    help="Use WAL mode, synchronous=NORMAL and a larger cache for bulk inserts",
+)
+@click.option(
+    "--lines",
+    is_flag=True,
+    help="Store text, confidence and bounding box of each line in a lines table",
+)
+@click.option(
+    "--words",
+    is_flag=True,
+    help="Store text, confidence and bounding box of each word in a words table",
+)
+@click.option(
+    "--compress",
+    is_flag=True,
+    help="Store page text compressed using zlib",
+)
+@click.option(
+    "--max-seconds",
+    type=click.FloatRange(min=0),
+    help="Stop starting new documents after this many seconds",
+)
+@click.option(
+    "--max-jobs",
+    type=click.IntRange(min=0),
+    help="Stop after fetching this many OCR jobs",
+)
+@click.option(
+    "--replan",
+    is_flag=True,
+    help="List the bucket again instead of resuming an unfinished run",
+)
 @common_boto3_options
-def index(bucket, database, **boto_options):
-    "Create a SQLite database with OCR results for files in a bucket"
+def index(
+    bucket,
+    database,
+    workers,
+    fast,
+    lines,
+    words,
+    compress,
+    max_seconds,
+    max_jobs,
+    replan,
+    **boto_options,
+):
+    """
+    Create a SQLite database with OCR results for files in a bucket
+
+        s3-ocr index name-of-bucket index.db
+
+    Running this again against the same database will only fetch documents
+    that are new or have changed, and will remove pages for documents that
+    are no longer in the bucket.
+
+    To fetch and process OCR results using four worker processes, each
+    writing to its own shard database before they are merged together:
+
+        s3-ocr index name-of-bucket index.db --workers 4
+
+    Use --fast to switch the database to WAL mode and apply SQLite settings
+    that speed up bulk inserts. Tools such as Datasette can continue to read
+    from a WAL database while it is being written to.
+
+    Use --lines and --words to also store each line or word of text along
+    with its confidence score and bounding box.
+
+    Use --compress to store page text compressed with zlib. Once a database
+    has been compressed later runs will continue to compress new pages.
+
+    To index a large bucket in slices, for example from cron:
+
+        s3-ocr index name-of-bucket index.db --max-seconds 600
+
+    The list of OCR results still to be fetched is saved in the database, so
+    the next run picks up where the last one stopped without listing the
+    bucket again. Use --replan to check the bucket for changes instead.
+    """
+    # Listing the bucket counts against --max-seconds too
+    started = time.monotonic()
     db = sqlite_utils.Database(database)
+    if fast:
+        apply_fast_pragmas(db)
+    # codec is None unless this database stores compressed text
+    codec = register_text_function(db.conn)
     if not db["pages"].exists():
         db["pages"].create(
             {"path": str, "page": int, "folder": str, "text": str}, pk=("path", "page")
         )
+    if codec is None and not db["pages"].detect_fts():
         db["pages"].enable_fts(["text"], create_triggers=True)
-    s3 = make_client("s3", **boto_options)
+    if not db["ocr_jobs"].exists():
+        db["ocr_jobs"].create(
+            {
+                "key": str,
+                "job_id": str,
+                "etag": str,
+                "s3_ocr_etag": str,
+                "chunks": str,
+            },
+            pk="key",
+        )
+    elif "chunks" not in db["ocr_jobs"].columns_dict:
+        # Databases created by older versions of s3-ocr
+        db["ocr_jobs"].add_column("chunks", str)
+    if not db["fetched_jobs"].exists():
+        db["fetched_jobs"].create({"job_id": str}, pk="job_id")
+    leftover_layout_tables = [table for table in LAYOUT_TABLES if db[table].exists()]
+    if merge_shard_directory(
+        db, shard_directory(database), leftover_layout_tables, codec
+    ):
+        click.echo("Merged pages fetched by an interrupted run", err=True)
+    for table, enabled in (("lines", lines), ("words", words)):
+        if enabled and not db[table].exists():
+            create_layout_table(db, table)
+            # Documents that have already been indexed need fetching again
+            db.execute("DELETE FROM fetched_jobs")
+            replan = True
+    # Once created these tables are kept up-to-date by every index run
+    layout_tables = [table for table in LAYOUT_TABLES if db[table].exists()]
+    if not db["index_plan"].exists():
+        db["index_plan"].create(
+            {"key": str, "job_id": str, "page_offset": int, "size": int}, pk="key"
+        )
+    # Resolve credentials once, so they can be passed to worker processes
+    s3_kwargs = client_kwargs(**boto_options)
+    s3 = instrument(boto3.client("s3", **s3_kwargs))
+    if replan or not db["index_plan"].count:
+        plan_index(db, s3, bucket, layout_tables)
+    else:
+        click.echo(
+            "Resuming previous run - use --replan to check the bucket for changes",
+            err=True,
+        )
+    items_by_job_id, paths_by_job_id, done_length, total_length = load_plan(db)
+    # --max-seconds and --max-jobs stop new jobs from being started, leaving
+    # the rest of the plan for the next run
+    deadline = started + max_seconds if max_seconds is not None else None
+
+    def within_budget(jobs_started):
+        if max_jobs is not None and jobs_started >= max_jobs:
+            return False
+        return deadline is None or time.monotonic() < deadline
+
+    jobs_started = 0
+    if compress and codec is None:
+        # The compression dictionary is built from a sample of the pages that
+        # are already in the database or, failing that, the first document
+        first_job = None
+        sample = [
+            row[0]
+            for row in db.conn.execute(
+                "SELECT text FROM pages WHERE text != '' LIMIT 1000"
+            )
+        ]
+        if not sample and items_by_job_id and within_budget(jobs_started):
+            jobs_started += 1
+            job_id = next(iter(items_by_job_id))
+            job_items = items_by_job_id.pop(job_id)
+            done_length += sum(item["Size"] for item, _ in job_items)
+            try:
+                pages, layout = fetch_job_pages(s3, bucket, job_items, layout_tables)
+            except s3.exceptions.NoSuchKey:
+                skip_missing_job(db, job_id)
+            else:
+                sample = ["\n".join(lines) for lines in pages.values() if lines]
+                first_job = (job_id, pages, layout)
+        if sample:
+            codec = enable_compression(db, build_zdict(sample))
+        if first_job is not None:
+            job_id, pages, layout = first_job
+            replace_pages(db, paths_by_job_id[job_id], job_id, pages, layout, codec)
+    with click.progressbar(length=total_length, label="Populating pages table") as bar:
+        bar.update(done_length)
+        if workers == 1:
+            for job_id, job_items in items_by_job_id.items():
+                if not within_budget(jobs_started):
+                    break
+                jobs_started += 1
+                try:
+                    pages, layout = fetch_job_pages(
+                        s3, bucket, job_items, layout_tables, on_item=bar.update
+                    )
+                except s3.exceptions.NoSuchKey:
+                    skip_missing_job(db, job_id)
+                    continue
+                replace_pages(db, paths_by_job_id[job_id], job_id, pages, layout, codec)
+        else:
+            # Each worker process writes to its own shard database, which
+            # are then merged in to the main database at the end. Shards
+            # left behind by an interrupted run are merged by the next run.
+            shard_dir = shard_directory(database)
+            os.makedirs(shard_dir, exist_ok=True)
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_shard_worker,
+                initargs=(
+                    shard_dir,
+                    bucket,
+                    s3_kwargs,
+                    layout_tables,
+                    current_stats() is not None,
+                    codec.zdict if codec is not None else None,
+                    fast,
+                ),
+            ) as executor:
+                # Jobs are submitted a few at a time, so that submitting
+                # can stop as soon as the budget runs out
+                jobs = iter(items_by_job_id.items())
+                pending = set()
+                while True:
+                    while len(pending) < workers * 2 and within_budget(jobs_started):
+                        job_id, job_items = next(jobs, (None, None))
+                        if job_id is None:
+                            break
+                        jobs_started += 1
+                        future = executor.submit(
+                            _index_shard_job,
+                            job_id,
+                            paths_by_job_id[job_id],
+                            job_items,
+                        )
+                        future.job_id = job_id
+                        pending.add(future)
+                    if not pending:
+                        break
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        size, worker_stats, missing = future.result()
+                        if missing:
+                            skip_missing_job(db, future.job_id)
+                        if worker_stats is not None:
+                            current_stats().merge(worker_stats)
+                        bar.update(size)
+            merge_shard_directory(db, shard_dir, layout_tables, codec)
+    remaining = db.execute(
+        "SELECT count(DISTINCT job_id) FROM index_plan "
+        "WHERE job_id NOT IN (SELECT job_id FROM fetched_jobs)"
+    ).fetchone()[0]
+    if remaining:
+        click.echo(
+            "Stopped with {} job{} left to fetch - run again to continue".format(
+                remaining, "" if remaining == 1 else "s"
+            ),
+            err=True,
+        )
+    else:
+        with db.conn:
+            db.conn.execute("DELETE FROM index_plan")
+    if fast:
+        # Leave a small WAL file and up-to-date statistics for readers
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.execute("PRAGMA optimize")
+
+
+def plan_index(db, s3, bucket, layout_tables):
+    """
+    List the bucket, bring the ocr_jobs table up to date and save the list of
+    textract-output/ files that need to be fetched in the index_plan table
+    """
     items = list(paginate(s3, "list_objects_v2", "Contents", Bucket=bucket))
-    # We don't need to fetch files that already exist in our ocr_jobs table
-    # and have the expected ETag
-    existing_ocr_jobs = set()
-    if db["ocr_jobs"].exists():
-        existing_ocr_jobs = {
-            (row["key"], row["s3_ocr_etag"])
-            for row in db.query("SELECT key, s3_ocr_etag FROM ocr_jobs")
-        }
-    to_fetch = [
-        item
+    markers = {
+        strip_ocr_json(item["Key"]): item
         for item in items
         if item["Key"].endswith(S3_OCR_JSON)
-        and (strip_ocr_json(item["Key"]), item["ETag"]) not in existing_ocr_jobs
+    }
+    # Diff the listing against the ocr_jobs table: we only need to fetch
+    # .s3-ocr.json files that are new or that have a different ETag
+    existing_ocr_jobs = {
+        row["key"]: row
+        for row in db.query("SELECT key, job_id, s3_ocr_etag FROM ocr_jobs")
+    }
+    to_fetch = [
+        item
+        for key, item in markers.items()
+        if key not in existing_ocr_jobs
+        or existing_ocr_jobs[key]["s3_ocr_etag"] != item["ETag"]
     ]
+    # Documents that have had their .s3-ocr.json file deleted
+    deleted_keys = [key for key in existing_ocr_jobs if key not in markers]
+
     # Now fetch those missing records
     def _fetch():
         for item in to_fetch:
@@ -465,104 +1226,562 @@ def index(bucket, database, **boto_options):
                 "job_id": data["job_id"],
                 "etag": data["etag"],
                 "s3_ocr_etag": response["ETag"],
+                "chunks": json.dumps(data["chunks"]) if "chunks" in data else None,
             }
 
     with click.progressbar(
         _fetch(), length=len(to_fetch), label="Fetching job details"
     ) as rows:
-        db["ocr_jobs"].insert_all(rows, pk="key", replace=True)
+        for row in rows:
+            previous = existing_ocr_jobs.get(row["key"])
+            with timer("sqlite.ocr_jobs"), db.conn:
+                if previous is None or previous["job_id"] != row["job_id"]:
+                    # Pages for this key need to be written from the new job,
+                    # even if that job was already fetched for another key
+                    db.conn.execute(
+                        "DELETE FROM fetched_jobs WHERE job_id = ?", [row["job_id"]]
+                    )
+                db.conn.execute(
+                    "INSERT OR REPLACE INTO ocr_jobs "
+                    "(key, job_id, etag, s3_ocr_etag, chunks) "
+                    "VALUES (:key, :job_id, :etag, :s3_ocr_etag, :chunks)",
+                    row,
+                )
 
-    # Now we can fetch any missing textract-output/<job_id>/<page> files
-    available_job_ids = {
-        item["Key"].split("textract-output/")[1].split("/")[0]
-        for item in items
-        if item["Key"].startswith("textract-output")
-    }
-    job_ids_in_ocr_jobs = set()
-    if db["ocr_jobs"].exists():
-        job_ids_in_ocr_jobs = {
-            r["job_id"] for r in db.query("SELECT job_id FROM ocr_jobs")
-        }
-    # Just fetch the ones that are not yet recorded as fetched in our database
-    # AND that are referenced from the ocr_jobs table
-    fetched_job_ids = set()
-    if db["fetched_jobs"].exists():
-        fetched_job_ids = {
-            r["job_id"] for r in db.query("SELECT job_id FROM fetched_jobs")
-        }
-    to_fetch_job_ids = list(
-        job_ids_in_ocr_jobs.intersection(available_job_ids - fetched_job_ids)
-    )
-    # Figure out total length to retrieve in bytes, for the progress bar
-    items_to_fetch = []
+    # Remove deleted documents, plus any pages or fetched jobs that are no
+    # longer referenced from the ocr_jobs table
+    with db.conn:
+        db.conn.executemany(
+            "DELETE FROM ocr_jobs WHERE key = ?", [(key,) for key in deleted_keys]
+        )
+        for table in ["pages"] + layout_tables:
+            db.conn.execute(
+                "DELETE FROM [{}] WHERE path NOT IN (SELECT key FROM ocr_jobs)".format(
+                    table
+                )
+            )
+        db.conn.execute(
+            "DELETE FROM fetched_jobs WHERE job_id NOT IN (SELECT job_id FROM ocr_jobs)"
+        )
+    if deleted_keys:
+        click.echo(
+            "Removed {} deleted document{}".format(
+                len(deleted_keys), "" if len(deleted_keys) == 1 else "s"
+            ),
+            err=True,
+        )
+
+    # Now we can plan which textract-output/<job_id>/<page> files to fetch
+    chunks_by_job_id = {}
+    for row in db.query("SELECT job_id, chunks FROM ocr_jobs"):
+        chunks_by_job_id[row["job_id"]] = marker_chunks(
+            {"job_id": row["job_id"], "chunks": json.loads(row["chunks"] or "null")}
+        )
+    fetched_job_ids = {r["job_id"] for r in db.query("SELECT job_id FROM fetched_jobs")}
+    output_items = {}
     for item in items:
         if (
-            item["Key"].startswith("textract-output")
-            and item["Key"].split("/")[1] in to_fetch_job_ids
+            item["Key"].startswith("textract-output/")
             and ".s3_access_check" not in item["Key"]
         ):
-            items_to_fetch.append(item)
-    total_length = sum(item["Size"] for item in items_to_fetch)
-    with click.progressbar(length=total_length, label="Populating pages table") as bar:
-        for item in items_to_fetch:
-            # Look up path based on job_id
-            bar.update(item["Size"])
-            job_id = item["Key"].split("textract-output/")[1].split("/")[0]
-            if db["ocr_jobs"].exists():
-                try:
-                    job_row = next(
-                        db.query("SELECT key FROM ocr_jobs WHERE job_id = ?", [job_id])
-                    )
-                except StopIteration:
-                    # This doesn't correspond to a job we know about
-                    click.echo("Missing job ID:", job_id, err=True)
-                    continue
-            path = job_row["key"]
-            blocks = json.loads(
-                s3.get_object(Bucket=bucket, Key=item["Key"])["Body"].read()
-            )["Blocks"]
-            # Just extract the line blocks
-            pages = {}
-            for block in blocks:
-                if block["BlockType"] == "LINE":
-                    page = block["Page"]
-                    if page not in pages:
-                        pages[page] = []
-                    pages[page].append(block["Text"])
-            # And insert those into the database
+            output_items.setdefault(item["Key"].split("/")[1], []).append(item)
+    # Just fetch the ones that are not yet recorded as fetched in our database
+    # AND that are referenced from the ocr_jobs table. Documents split with
+    # --split-pages wait until every one of their chunks has some output.
+    plan = []
+    for job_id, chunks in chunks_by_job_id.items():
+        if job_id in fetched_job_ids:
+            continue
+        if all(chunk_job_id in output_items for chunk_job_id, _ in chunks):
+            plan.extend(
+                (item["Key"], job_id, offset, item["Size"])
+                for chunk_job_id, offset in chunks
+                for item in output_items[chunk_job_id]
+            )
+    with db.conn:
+        db.conn.execute("DELETE FROM index_plan")
+        db.conn.executemany(
+            "INSERT INTO index_plan (key, job_id, page_offset, size) "
+            "VALUES (?, ?, ?, ?)",
+            plan,
+        )
+
+
+def skip_missing_job(db, job_id):
+    # The bucket has changed since the plan was saved - the job is listed
+    # again, if it still exists, the next time the plan is made
+    with db.conn:
+        db.conn.execute("DELETE FROM index_plan WHERE job_id = ?", [job_id])
+    click.echo(
+        "Skipped job {}: its OCR results are no longer in the bucket. "
+        "Run again with --replan to check the bucket for changes".format(job_id),
+        err=True,
+    )
+
+
+def load_plan(db):
+    """
+    Returns the saved plan as a dictionary mapping job IDs that still need
+    to be fetched to their (item, page offset) pairs, a dictionary mapping
+    job IDs to paths, and the number of bytes done and in total
+    """
+    fetched_job_ids = {r["job_id"] for r in db.query("SELECT job_id FROM fetched_jobs")}
+    paths_by_job_id = {}
+    for row in db.query("SELECT key, job_id FROM ocr_jobs"):
+        paths_by_job_id.setdefault(row["job_id"], []).append(row["key"])
+    items_by_job_id = {}
+    done_length = total_length = 0
+    for row in db.query(
+        "SELECT key, job_id, page_offset, size FROM index_plan ORDER BY rowid"
+    ):
+        total_length += row["size"]
+        if row["job_id"] in fetched_job_ids or row["job_id"] not in paths_by_job_id:
+            done_length += row["size"]
+            continue
+        items_by_job_id.setdefault(row["job_id"], []).append(
+            ({"Key": row["key"], "Size": row["size"]}, row["page_offset"])
+        )
+    return items_by_job_id, paths_by_job_id, done_length, total_length
+
+
+@cli.command()
+@click.argument(
+    "database",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@click.argument("query")
+@click.option("--folder", help="Only search pages within this folder")
+@click.option(
+    "-l",
+    "--limit",
+    type=click.IntRange(min=1),
+    default=20,
+    help="Number of results to return",
+)
+@click.option(
+    "--offset",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Skip this many results, for pagination",
+)
+@click.option("--raw", is_flag=True, help="Use SQLite FTS5 query syntax")
+@click.option("--json", "json_", is_flag=True, help="Output results as JSON")
+def search(database, query, folder, limit, offset, raw, json_):
+    """
+    Search the text of pages in a database created by 's3-ocr index'
+
+        s3-ocr search index.db 'climate change'
+
+    Results are ordered by relevance. To see the next page of results:
+
+        s3-ocr search index.db 'climate change' --offset 20
+    """
+    search_index = SearchIndex(database)
+    try:
+        with timer("sqlite.search"):
+            results = search_index.search(
+                query, folder=folder, limit=limit, offset=offset, raw=raw
+            )
+    except sqlite3.OperationalError as ex:
+        raise click.ClickException(str(ex))
+    finally:
+        search_index.close()
+    if json_:
+        click.echo(json.dumps(results, indent=2))
+        return
+    for result in results:
+        click.echo("{} (page {})".format(result["path"], result["page"]))
+        click.echo("    {}".format(" ".join(result["snippet"].split())))
+
+
+def job_output_items(s3, bucket, key):
+    "Find the textract-output/ files for a key, using its .s3-ocr.json file"
+    items = list(paginate(s3, "list_objects_v2", "Contents", Bucket=bucket, Prefix=key))
+    keys_with_s3_ocr_files = [
+        strip_ocr_json(item["Key"])
+        for item in items
+        if item["Key"].endswith(S3_OCR_JSON)
+    ]
+    if not keys_with_s3_ocr_files:
+        raise click.ClickException("Key could not be found in bucket: {}".format(key))
+    # Read that file to find the job ID
+    try:
+        chunks = marker_chunks(
+            json.loads(
+                s3.get_object(
+                    Bucket=bucket, Key=keys_with_s3_ocr_files[0] + S3_OCR_JSON
+                )["Body"].read()
+            )
+        )
+    except Exception as e:
+        raise click.ClickException("Could not find job_id for key")
+    return chunk_output_items(s3, bucket, chunks)
+
+
+def marker_chunks(data):
+    """
+    Returns (job_id, offset) pairs for the decoded contents of a .s3-ocr.json
+    file - one pair for each chunk created by start --split-pages, or a
+    single pair with an offset of 0 for a document that was not split
+    """
+    if data.get("chunks"):
+        return [(chunk["job_id"], chunk["offset"]) for chunk in data["chunks"]]
+    return [(data["job_id"], 0)]
+
+
+def chunk_output_items(s3, bucket, chunks):
+    "List the textract-output/ files for each chunk, as (item, offset) pairs"
+    return [
+        (item, offset)
+        for job_id, offset in chunks
+        for item in paginate(
+            s3,
+            "list_objects_v2",
+            "Contents",
+            Bucket=bucket,
+            Prefix="textract-output/{}/".format(job_id),
+        )
+        if ".s3_access_check" not in item["Key"]
+    ]
+
+
+def fetch_blocks(s3, bucket, item):
+    "Download and decode the blocks in a single textract-output/ file"
+    body = s3.get_object(Bucket=bucket, Key=item["Key"])["Body"]
+    with timer("s3.GetObject.read"):
+        content = body.read()
+    with timer("json.parse"):
+        return json.loads(content)["Blocks"]
+
+
+def assemble_pages(blocks, pages, page_numbers=None, offset=0):
+    """
+    Group the text of LINE blocks by page, in a single pass
+
+    Lines are appended to the lists in the pages dictionary, keyed by page
+    number. If page_numbers is a set, the number of every PAGE block will be
+    added to it - including pages that have no lines of text.
+
+    offset is added to every page number, for chunks created by --split-pages
+    """
+    current_page = None
+    lines = None
+    for block in blocks:
+        block_type = block["BlockType"]
+        if block_type == "LINE":
+            page = block["Page"] + offset
+            # Blocks arrive in page order, so this avoids most dict lookups
+            if page != current_page:
+                current_page = page
+                lines = pages.get(page)
+                if lines is None:
+                    lines = pages[page] = []
+            lines.append(block["Text"])
+        elif block_type == "PAGE" and page_numbers is not None:
+            page_numbers.add(block["Page"] + offset)
+    return pages
+
+
+def offset_pages(blocks, offset):
+    "Add offset to the page number of every block, in place"
+    if offset:
+        for block in blocks:
+            if "Page" in block:
+                block["Page"] += offset
+    return blocks
+
+
+def fetch_job_pages(s3, bucket, job_items, layout_tables=(), on_item=None):
+    # A job's output can be split across several files, and a document split
+    # with --split-pages across several jobs - job_items is a list of
+    # (item, page offset) pairs. Returns a dictionary mapping page numbers to
+    # lists of lines, plus a dictionary of rows for each requested layout table
+    pages = {}
+    all_page_numbers = set()
+    layout = {table: [] for table in layout_tables}
+    tables_by_block_type = {LAYOUT_TABLES[table]: table for table in layout_tables}
+    ordinals = {}
+    for item, offset in job_items:
+        blocks = fetch_blocks(s3, bucket, item)
+        assemble_pages(blocks, pages, all_page_numbers, offset)
+        if tables_by_block_type:
+            add_layout_rows(blocks, tables_by_block_type, layout, ordinals, offset)
+        if on_item is not None:
+            on_item(item["Size"])
+    # Add a blank record for every page that is missing
+    for number in all_page_numbers:
+        if number not in pages:
+            pages[number] = []
+    return pages, layout
+
+
+def add_layout_rows(blocks, tables_by_block_type, layout, ordinals, offset=0):
+    for block in blocks:
+        table = tables_by_block_type.get(block["BlockType"])
+        if table is not None:
+            page = block["Page"] + offset
+            ordinal = ordinals.get((table, page), 0) + 1
+            ordinals[(table, page)] = ordinal
+            layout[table].append(
+                (
+                    page,
+                    ordinal,
+                    block["Text"],
+                    block.get("Confidence"),
+                    pack_bbox(block),
+                )
+            )
+
+
+def pack_bbox(block):
+    # Bounding boxes are stored as four little-endian 32-bit floats:
+    # left, top, width, height - each a ratio of the page dimensions
+    bbox = (block.get("Geometry") or {}).get("BoundingBox")
+    if not bbox:
+        return None
+    return struct.pack("<4f", bbox["Left"], bbox["Top"], bbox["Width"], bbox["Height"])
+
+
+def unpack_bbox(value):
+    "Turn a bbox column value back into a (left, top, width, height) tuple"
+    if value is None:
+        return None
+    return struct.unpack("<4f", value)
+
+
+def create_layout_table(db, table):
+    db[table].create(
+        {
+            "path": str,
+            "page": int,
+            "ordinal": int,
+            "text": str,
+            "confidence": float,
+            "bbox": bytes,
+        },
+        pk=("path", "page", "ordinal"),
+    )
+
+
+def replace_pages(db, paths, job_id, pages, layout=None, codec=None):
+    # Swap out every page for these paths in a single transaction, so pages
+    # left over from a previous OCR job never survive alongside the new ones
+    # and an interrupted run never leaves a job half written
+    encode = codec.compress if codec is not None else str
+    texts = {
+        page_number: encode("\n".join(lines)) for page_number, lines in pages.items()
+    }
+    with timer("sqlite.replace_pages"), db.conn:
+        for path in paths:
             folder = "/".join(path.split("/")[:-1])
-            for page_number, lines in pages.items():
-                db["pages"].insert(
-                    {
-                        "path": path,
-                        "page": page_number,
-                        "folder": folder,
-                        "text": "\n".join(lines),
-                    },
-                    replace=True,
+            db.conn.execute("DELETE FROM pages WHERE path = ?", [path])
+            db.conn.executemany(
+                "INSERT INTO pages (path, page, folder, text) VALUES (?, ?, ?, ?)",
+                [
+                    (path, page_number, folder, texts[page_number])
+                    for page_number in sorted(texts)
+                ],
+            )
+            for table, rows in (layout or {}).items():
+                db.conn.execute("DELETE FROM [{}] WHERE path = ?".format(table), [path])
+                db.conn.executemany(
+                    "INSERT INTO [{}] (path, page, ordinal, text, confidence, bbox) "
+                    "VALUES (?, ?, ?, ?, ?, ?)".format(table),
+                    [(path,) + row for row in rows],
                 )
-            # Add a blank record for every page that is missing
-            all_page_numbers = [
-                block["Page"] for block in blocks if block["BlockType"] == "PAGE"
-            ]
-            missing = [pn for pn in all_page_numbers if pn not in pages.keys()]
-            for number in missing:
-                db["pages"].insert(
-                    {
-                        "path": path,
-                        "page": number,
-                        "folder": folder,
-                        "text": "",
-                    },
-                    replace=True,
+        db.conn.execute(
+            "INSERT OR REPLACE INTO fetched_jobs (job_id) VALUES (?)", [job_id]
+        )
+
+
+def apply_fast_pragmas(db):
+    "Switch to WAL mode and apply the index --fast settings to a connection"
+    db.enable_wal()
+    for pragma, value in FAST_PRAGMAS:
+        db.execute("PRAGMA {} = {}".format(pragma, value))
+
+
+# State for each worker process used by index --workers
+_shard = {}
+
+
+def _init_shard_worker(
+    shard_dir, bucket, s3_kwargs, layout_tables, collect_stats, zdict, fast
+):
+    shard_db = sqlite_utils.Database(
+        os.path.join(shard_dir, "shard-{}.db".format(os.getpid()))
+    )
+    if fast:
+        # Most of the writes for index --workers go to the shards
+        apply_fast_pragmas(shard_db)
+    shard_db["pages"].create(
+        {"path": str, "page": int, "folder": str, "text": str}, pk=("path", "page")
+    )
+    shard_db["fetched_jobs"].create({"job_id": str}, pk="job_id")
+    for table in layout_tables:
+        create_layout_table(shard_db, table)
+    _shard["db"] = shard_db
+    _shard["layout_tables"] = layout_tables
+    _shard["bucket"] = bucket
+    _shard["codec"] = TextCodec(zdict) if zdict is not None else None
+    if collect_stats:
+        _shard["stats"] = Stats()
+    _shard["s3"] = instrument(boto3.client("s3", **s3_kwargs))
+
+
+def _index_shard_job(job_id, paths, job_items):
+    try:
+        pages, layout = fetch_job_pages(
+            _shard["s3"], _shard["bucket"], job_items, _shard["layout_tables"]
+        )
+    except _shard["s3"].exceptions.NoSuchKey:
+        missing = True
+    else:
+        missing = False
+        replace_pages(_shard["db"], paths, job_id, pages, layout, _shard["codec"])
+    # Statistics are sent back to the main process after each job
+    worker_stats = None
+    if "stats" in _shard:
+        worker_stats = _shard["stats"].to_dict()
+        _shard["stats"].operations.clear()
+    return sum(item["Size"] for item, _ in job_items), worker_stats, missing
+
+
+def shard_directory(database):
+    "Directory next to the database where index --workers keeps its shards"
+    directory, filename = os.path.split(os.path.abspath(database))
+    return os.path.join(directory, ".s3-ocr-shards-{}".format(filename))
+
+
+def merge_shard_directory(db, shard_dir, layout_tables=(), codec=None):
+    """
+    Merge every shard database in shard_dir in to the main database, then
+    delete the directory. Returns the number of shards that were merged.
+    """
+    if not os.path.isdir(shard_dir):
+        return 0
+    shard_paths = [
+        os.path.join(shard_dir, filename)
+        for filename in sorted(os.listdir(shard_dir))
+        if filename.endswith(".db")
+    ]
+    if shard_paths:
+        merge_shards(db, shard_paths, layout_tables, codec)
+    shutil.rmtree(shard_dir)
+    return len(shard_paths)
+
+
+def merge_shards(db, shard_paths, layout_tables=(), codec=None):
+    with timer("sqlite.merge_shards"):
+        _merge_shards(db, shard_paths, layout_tables, codec)
+
+
+def _merge_shards(db, shard_paths, layout_tables, codec):
+    # When building a new index the search index is built once at the end,
+    # rather than being updated by triggers for every row that is copied
+    # across. Incremental runs leave the triggers to index the new rows.
+    rebuild_fts = db.execute("SELECT 1 FROM pages LIMIT 1").fetchone() is None
+    if rebuild_fts:
+        if codec is None:
+            db["pages"].disable_fts()
+        else:
+            drop_compressed_fts(db)
+    tables = {"pages": "path, page, folder, text"}
+    for table in layout_tables:
+        tables[table] = "path, page, ordinal, text, confidence, bbox"
+    for shard_path in shard_paths:
+        db.conn.execute("ATTACH DATABASE ? AS shard", [shard_path])
+        with db.conn:
+            for table, columns in tables.items():
+                db.conn.execute("""
+                    DELETE FROM [{table}] WHERE path IN (
+                        SELECT key FROM ocr_jobs
+                        WHERE job_id IN (SELECT job_id FROM shard.fetched_jobs)
+                    )
+                    """.format(table=table))
+                db.conn.execute(
+                    "INSERT INTO [{table}] ({columns}) "
+                    "SELECT {columns} FROM shard.[{table}]".format(
+                        table=table, columns=columns
+                    )
                 )
-            db["fetched_jobs"].insert(
-                {
-                    "job_id": job_id,
-                },
-                replace=True,
-                pk="job_id",
+            db.conn.execute(
+                "INSERT OR REPLACE INTO fetched_jobs (job_id) "
+                "SELECT job_id FROM shard.fetched_jobs"
             )
+        db.conn.execute("DETACH DATABASE shard")
+    if rebuild_fts:
+        if codec is None:
+            db["pages"].enable_fts(["text"], create_triggers=True)
+        else:
+            create_compressed_fts(db)
+
+
+def enable_compression(db, zdict):
+    """
+    Switch a database to storing compressed page text, compressing any pages
+    that are already stored and rebuilding the search index. Returns the
+    TextCodec to use for new pages.
+    """
+    codec = TextCodec(zdict)
+    register_text_function(db.conn, codec)
+    create_function(db.conn, "s3_ocr_compress", codec.compress)
+    db["pages"].disable_fts()
+    if not db[SETTINGS_TABLE].exists():
+        db[SETTINGS_TABLE].create({"key": str, "value": bytes}, pk="key")
+    with db.conn:
+        db.conn.execute(
+            "INSERT OR REPLACE INTO [{}] (key, value) VALUES ('zdict', ?)".format(
+                SETTINGS_TABLE
+            ),
+            [zdict],
+        )
+        converted = db.conn.execute(
+            "UPDATE pages SET text = s3_ocr_compress(text) "
+            "WHERE typeof(text) = 'text'"
+        ).rowcount
+    create_compressed_fts(db)
+    if converted:
+        # Reclaim the space used by the uncompressed text
+        db.vacuum()
+    return codec
+
+
+def create_compressed_fts(db):
+    # The FTS table reads page text through a view that decompresses it, so
+    # the text is not stored a second time. Anything that reads the content
+    # of pages_fts, including snippet(), needs the s3_ocr_text() function.
+    db.executescript("""
+        CREATE VIEW IF NOT EXISTS pages_text AS
+            SELECT rowid AS page_rowid, s3_ocr_text(text) AS text FROM pages;
+        CREATE VIRTUAL TABLE pages_fts USING FTS5 (
+            text, content=[pages_text], content_rowid=[page_rowid]
+        );
+        CREATE TRIGGER pages_ai AFTER INSERT ON pages BEGIN
+            INSERT INTO pages_fts (rowid, text)
+                VALUES (new.rowid, s3_ocr_text(new.text));
+        END;
+        CREATE TRIGGER pages_ad AFTER DELETE ON pages BEGIN
+            INSERT INTO pages_fts (pages_fts, rowid, text)
+                VALUES ('delete', old.rowid, s3_ocr_text(old.text));
+        END;
+        CREATE TRIGGER pages_au AFTER UPDATE ON pages BEGIN
+            INSERT INTO pages_fts (pages_fts, rowid, text)
+                VALUES ('delete', old.rowid, s3_ocr_text(old.text));
+            INSERT INTO pages_fts (rowid, text)
+                VALUES (new.rowid, s3_ocr_text(new.text));
+        END;
+        INSERT INTO pages_fts (pages_fts) VALUES ('rebuild');
+    """)
+
+
+def drop_compressed_fts(db):
+    db.executescript("""
+        DROP TRIGGER IF EXISTS pages_ai;
+        DROP TRIGGER IF EXISTS pages_ad;
+        DROP TRIGGER IF EXISTS pages_au;
+        DROP TABLE IF EXISTS pages_fts;
+    """)
 
 
 def paginate(service, method, list_key, **kwargs):
@@ -574,3 +1793,8 @@ def paginate(service, method, list_key, **kwargs):
 def start_document_text_extraction(textract, **kwargs):
     # Wrapper function to make this easier to mock in tests
     return textract.start_document_text_detection(**kwargs)
+
+
+def get_job_status(textract, job_id):
+    # Wrapper function to make this easier to mock in tests
+    return textract.get_document_text_detection(JobId=job_id, MaxResults=1)["JobStatus"]
@@ -0,0 +1,92 @@
+import collections
+import sys
+import zlib
+
+# Preset dictionaries are limited to the size of the zlib window
+ZDICT_SIZE = 32 * 1024
+
+# Pages are written once and read many times, so use the best compression
+COMPRESSION_LEVEL = 9
+
+# The dictionary is stored in this table, under the "zdict" key
+SETTINGS_TABLE = "s3_ocr_settings"
+
+
+class TextCodec:
+    """
+    Compresses and decompresses page text using zlib with a preset
+    dictionary shared by every page.
+
+    decompress() passes str values through unchanged, so a column can hold
+    a mix of compressed and uncompressed text.
+    """
+
+    def __init__(self, zdict):
+        self.zdict = zdict
+
+    def compress(self, text):
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=self.zdict)
+        return compressor.compress(text.encode("utf8")) + compressor.flush()
+
+    def decompress(self, value):
+        if not isinstance(value, bytes):
+            return value
+        decompressor = zlib.decompressobj(zdict=self.zdict)
+        return (decompressor.decompress(value) + decompressor.flush()).decode("utf8")
+
+
+def build_zdict(texts, size=ZDICT_SIZE):
+    """
+    Build a preset dictionary from a sample of page text, made up of the
+    words that appear most often in that sample
+    """
+    counts = collections.Counter(word for text in texts for word in text.split())
+    chosen = []
+    total = 0
+    for word, count in counts.most_common():
+        if count < 2:
+            break
+        encoded = word.encode("utf8") + b" "
+        if total + len(encoded) > size:
+            break
+        chosen.append(encoded)
+        total += len(encoded)
+    # zlib matches are cheapest to encode when they are close to the end of
+    # the dictionary, so the most common words go last
+    return b"".join(reversed(chosen))
+
+
+def load_codec(conn):
+    "Returns the TextCodec for a database, or None if text is not compressed"
+    columns = {
+        row[1] for row in conn.execute("PRAGMA table_info([{}])".format(SETTINGS_TABLE))
+    }
+    if not {"key", "value"} <= columns:
+        return None
+    row = conn.execute(
+        "SELECT value FROM [{}] WHERE key = 'zdict'".format(SETTINGS_TABLE)
+    ).fetchone()
+    return TextCodec(row[0]) if row else None
+
+
+def create_function(conn, name, fn):
+    "Register a single argument SQL function that always returns the same result"
+    # The deterministic= argument was added in Python 3.8
+    kwargs = {"deterministic": True} if sys.version_info >= (3, 8) else {}
+    conn.create_function(name, 1, fn, **kwargs)
+
+
+def register_text_function(conn, codec=None):
+    """
+    Register the s3_ocr_text(text) SQL function on a connection, which
+    returns the decompressed version of a pages.text value. Returns the
+    codec that is used, which is loaded from the database if not provided.
+    """
+    if codec is None:
+        codec = load_codec(conn)
+    create_function(
+        conn,
+        "s3_ocr_text",
+        codec.decompress if codec is not None else lambda value: value,
+    )
+    return codec
@@ -0,0 +1,161 @@
+import functools
+import pathlib
+import sqlite3
+import threading
+from .compression import register_text_function
+
+SEARCH_SQL = """
+    SELECT
+        pages.path,
+        pages.page,
+        pages.folder,
+        snippet(pages_fts, -1, :start, :end, '...', :tokens) AS snippet,
+        pages_fts.rank AS rank
+    FROM pages_fts
+    JOIN pages ON pages.rowid = pages_fts.rowid
+    WHERE pages_fts MATCH :query{folder_clause}
+    ORDER BY pages_fts.rank
+    LIMIT :limit OFFSET :offset
+"""
+
+COUNT_SQL = """
+    SELECT count(*)
+    FROM pages_fts
+    JOIN pages ON pages.rowid = pages_fts.rowid
+    WHERE pages_fts MATCH :query{folder_clause}
+"""
+
+# Matches the folder itself plus any folders nested inside it
+FOLDER_CLAUSE = """
+    AND (
+        pages.folder = :folder
+        OR substr(pages.folder, 1, length(:folder) + 1) = :folder || '/'
+    )"""
+
+
+class SearchIndex:
+    """
+    Read-only access to a database created by 's3-ocr index'
+
+        index = SearchIndex("index.db")
+        for result in index.search("climate change", folder="reports"):
+            print(result["path"], result["page"], result["snippet"])
+
+    It is safe to share one SearchIndex between threads: each thread gets
+    its own read-only SQLite connection. Each connection keeps compiled
+    versions of the statements it has run, so repeated searches skip the
+    SQL parsing and planning step.
+
+    Pass cache_size=N to keep the results of the N most recent distinct
+    searches in memory. Cached results are not updated if the database
+    changes - call clear_cache() after re-running 's3-ocr index'.
+    """
+
+    def __init__(self, path, cache_size=0):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._cached_search = None
+        if cache_size:
+            self._cached_search = functools.lru_cache(maxsize=cache_size)(self._search)
+
+    def connection(self):
+        "Returns the read-only connection for the current thread"
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                pathlib.Path(self.path).resolve().as_uri() + "?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+            conn.row_factory = sqlite3.Row
+            # Decompresses text for databases created using index --compress
+            register_text_function(conn)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def search(
+        self,
+        query,
+        folder=None,
+        limit=20,
+        offset=0,
+        raw=False,
+        highlight=("[", "]"),
+        snippet_tokens=16,
+    ):
+        """
+        Returns a list of {"path", "page", "folder", "snippet", "rank"}
+        dictionaries for pages matching the query, best matches first.
+
+        The query is treated as a list of words that must all appear on the
+        page. Use raw=True to use the full SQLite FTS5 query syntax instead.
+        """
+        if not raw and not query.strip():
+            return []
+        folder = normalize_folder(folder)
+        args = (query, folder, limit, offset, raw, tuple(highlight), snippet_tokens)
+        if self._cached_search is not None:
+            return list(self._cached_search(*args))
+        return self._search(*args)
+
+    def count(self, query, folder=None, raw=False):
+        "Returns the total number of pages matching the query"
+        if not raw and not query.strip():
+            return 0
+        folder = normalize_folder(folder)
+        sql = COUNT_SQL.format(folder_clause=FOLDER_CLAUSE if folder else "")
+        params = {"query": query if raw else quote_query(query), "folder": folder}
+        return self.connection().execute(sql, params).fetchone()[0]
+
+    def page_text(self, path, page):
+        "Returns the full text of a page, or None if it is not in the index"
+        row = (
+            self.connection()
+            .execute(
+                "SELECT s3_ocr_text(text) FROM pages WHERE path = ? AND page = ?",
+                [path, page],
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def clear_cache(self):
+        if self._cached_search is not None:
+            self._cached_search.cache_clear()
+
+    def close(self):
+        "Close the connections that have been opened by every thread"
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _search(self, query, folder, limit, offset, raw, highlight, snippet_tokens):
+        sql = SEARCH_SQL.format(folder_clause=FOLDER_CLAUSE if folder else "")
+        params = {
+            "query": query if raw else quote_query(query),
+            "folder": folder,
+            "start": highlight[0],
+            "end": highlight[1],
+            "tokens": snippet_tokens,
+            "limit": limit,
+            "offset": offset,
+        }
+        return [dict(row) for row in self.connection().execute(sql, params)]
+
+
+def normalize_folder(folder):
+    "Folders can be written like prefixes, with a trailing slash"
+    return folder.rstrip("/") if folder else folder
+
+
+def quote_query(query):
+    "Quote every word in a query, so FTS5 syntax characters are not special"
+    return " ".join(
+        '"{}"'.format(word.replace('"', '""')) for word in query.split() if word
+    )
@@ -0,0 +1,228 @@
+import contextlib
+import threading
+import time
+
+# Upper bounds, in milliseconds, of the latency histogram buckets
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+THROTTLE_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "LimitExceededException",
+    "SlowDown",
+}
+
+
+class Stats:
+    """
+    Counts calls, bytes, retries, throttles and latency for each operation.
+
+    AWS operations are recorded by calling instrument(client) on a boto3
+    client. Anything else can be recorded using the timer() context manager.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self._lock = threading.Lock()
+        self._hooks = []
+
+    def add_hook(self, fn):
+        "Call fn(operation, seconds) every time an operation is recorded"
+        self._hooks.append(fn)
+
+    def record(
+        self,
+        operation,
+        seconds,
+        bytes_in=0,
+        bytes_out=0,
+        retries=0,
+        throttles=0,
+        error=False,
+        calls=1,
+    ):
+        with self._lock:
+            op = self.operations.get(operation)
+            if op is None:
+                op = self.operations[operation] = _empty_operation()
+            op["calls"] += calls
+            op["errors"] += int(error)
+            op["retries"] += retries
+            op["throttles"] += throttles
+            op["bytes_in"] += bytes_in
+            op["bytes_out"] += bytes_out
+            op["total_seconds"] += seconds
+            op["max_seconds"] = max(op["max_seconds"], seconds)
+            if calls:
+                op["histogram"][_bucket_index(seconds)] += 1
+        for hook in self._hooks:
+            hook(operation, seconds)
+
+    def count(self, operation, **kwargs):
+        "Record bytes, retries or throttles without recording a call"
+        self.record(operation, 0, calls=0, **kwargs)
+
+    @contextlib.contextmanager
+    def timer(self, operation):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record(operation, time.perf_counter() - start, error=error)
+
+    def instrument(self, client):
+        "Record every API call made using this boto3 client"
+        service = client.meta.service_model.service_name
+        events = client.meta.events
+
+        def before_call(model, params, context, **kwargs):
+            context["s3_ocr_stats_start"] = time.perf_counter()
+            body = params.get("body")
+            context["s3_ocr_stats_bytes_out"] = (
+                len(body) if isinstance(body, (bytes, str)) else 0
+            )
+
+        def after_call(http_response, parsed, model, context, **kwargs):
+            metadata = parsed.get("ResponseMetadata") or {}
+            self.record(
+                "{}.{}".format(service, model.name),
+                _elapsed(context),
+                bytes_in=int(http_response.headers.get("content-length") or 0),
+                bytes_out=context.get("s3_ocr_stats_bytes_out", 0),
+                retries=metadata.get("RetryAttempts", 0),
+                error=http_response.status_code >= 300,
+            )
+
+        def after_call_error(exception, context, event_name, **kwargs):
+            self.record(
+                "{}.{}".format(service, event_name.split(".")[-1]),
+                _elapsed(context),
+                error=True,
+            )
+
+        def needs_retry(response, operation, **kwargs):
+            if response is not None:
+                code = (response[1].get("Error") or {}).get("Code")
+                if code in THROTTLE_ERROR_CODES:
+                    self.count("{}.{}".format(service, operation.name), throttles=1)
+            # Returning None leaves the retry decision to botocore
+
+        events.register("before-call", before_call)
+        events.register("after-call", after_call)
+        events.register("after-call-error", after_call_error)
+        events.register("needs-retry", needs_retry)
+        return client
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "latency_buckets_ms": list(LATENCY_BUCKETS_MS),
+                "operations": {
+                    name: dict(op, histogram=list(op["histogram"]))
+                    for name, op in sorted(self.operations.items())
+                },
+            }
+
+    def merge(self, data):
+        "Merge in the result of to_dict() from another Stats instance"
+        with self._lock:
+            for name, other in data["operations"].items():
+                op = self.operations.get(name)
+                if op is None:
+                    op = self.operations[name] = _empty_operation()
+                for key in (
+                    "calls",
+                    "errors",
+                    "retries",
+                    "throttles",
+                    "bytes_in",
+                    "bytes_out",
+                    "total_seconds",
+                ):
+                    op[key] += other[key]
+                op["max_seconds"] = max(op["max_seconds"], other["max_seconds"])
+                op["histogram"] = [
+                    a + b for a, b in zip(op["histogram"], other["histogram"])
+                ]
+
+    def summary(self):
+        "Return a plain text table summarizing the recorded operations"
+        headers = (
+            "operation",
+            "calls",
+            "errors",
+            "retries",
+            "throttles",
+            "bytes in",
+            "bytes out",
+            "total s",
+            "mean ms",
+            "max ms",
+        )
+        rows = []
+        for name, op in sorted(self.to_dict()["operations"].items()):
+            mean = op["total_seconds"] / op["calls"] if op["calls"] else 0
+            rows.append(
+                (
+                    name,
+                    op["calls"],
+                    op["errors"],
+                    op["retries"],
+                    op["throttles"],
+                    op["bytes_in"],
+                    op["bytes_out"],
+                    "{:.3f}".format(op["total_seconds"]),
+                    "{:.1f}".format(mean * 1000),
+                    "{:.1f}".format(op["max_seconds"] * 1000),
+                )
+            )
+        widths = [
+            max(len(str(row[i])) for row in [headers] + rows)
+            for i in range(len(headers))
+        ]
+        lines = []
+        for row in [headers] + rows:
+            lines.append(
+                "  ".join(
+                    str(value).ljust(width) if i == 0 else str(value).rjust(width)
+                    for i, (value, width) in enumerate(zip(row, widths))
+                )
+            )
+        return "\n".join(lines)
+
+
+def _empty_operation():
+    return {
+        "calls": 0,
+        "errors": 0,
+        "retries": 0,
+        "throttles": 0,
+        "bytes_in": 0,
+        "bytes_out": 0,
+        "total_seconds": 0.0,
+        "max_seconds": 0.0,
+        # One extra bucket for anything slower than the last bound
+        "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+    }
+
+
+def _bucket_index(seconds):
+    ms = seconds * 1000
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+def _elapsed(context):
+    start = context.get("s3_ocr_stats_start")
+    return time.perf_counter() - start if start is not None else 0.0
@@ -32,6 +32,9 @@ setup(
         s3-ocr=s3_ocr.cli:cli
     """,
     install_requires=["click>=8.0", "boto3", "sqlite-utils"],
-    extras_require={"test": ["pytest", "moto[s3,textract]", "cogapp", "pytest-mock"]},
+    extras_require={
+        "split": ["pypdf"],
+        "test": ["pytest", "moto[s3,textract]", "cogapp", "pytest-mock", "pypdf"],
+    },
     python_requires=">=3.7",
 )
@@ -1,11 +1,17 @@
+import concurrent.futures
+import datetime
 import boto3
 from click.testing import CliRunner
 from unittest.mock import ANY
 import sqlite_utils
-from s3_ocr.cli import cli
+from s3_ocr import SearchIndex
+from s3_ocr.compression import TextCodec, build_zdict
+import s3_ocr.cli
+from s3_ocr.cli import assemble_pages, cli, schedule, unpack_bbox
 import json
 import os
 import pytest
+import time
 import sqlite_utils
 
 
@@ -141,11 +147,406 @@ def test_index(s3, tmpdir):
             "job_id": "x",
             "etag": '"a4d0cb8bd505f67f3ea1cb5583e49550"',
             "s3_ocr_etag": ANY,
+            "chunks": None,
         }
     ]
     assert list(db["fetched_jobs"].rows) == [{"job_id": "x"}]
 
 
+def test_index_fast(s3, tmpdir):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["index", "my-bucket", index_db, "--fast"], catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(index_db)
+    assert db.journal_mode == "wal"
+    assert db["pages"].count == 3
+
+
+def test_index_fast_workers_shards(s3, tmpdir, mocker):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3, multi_page=True)
+    # Stop before the merge, so the shards can be inspected
+    mocker.patch("s3_ocr.cli.merge_shards", side_effect=OSError)
+    result = CliRunner().invoke(
+        cli, ["index", "my-bucket", index_db, "--fast", "--workers", "2"]
+    )
+    assert result.exit_code == 1
+    shard_dir = os.path.join(tmpdir, ".s3-ocr-shards-index.db")
+    shards = [
+        sqlite_utils.Database(os.path.join(shard_dir, filename))
+        for filename in os.listdir(shard_dir)
+        if filename.endswith(".db")
+    ]
+    assert shards
+    assert {shard.journal_mode for shard in shards} == {"wal"}
+
+
+def test_index_workers(s3, tmpdir):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["index", "my-bucket", index_db, "--workers", "2"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(index_db)
+    assert [(r["path"], r["page"], r["text"]) for r in db["pages"].rows] == [
+        ("foo/blah.pdf", 1, "Hello there\nline 2"),
+        ("foo/blah.pdf", 2, "Page two\nLine 2 of page 2"),
+        ("foo/blah.pdf", 3, ""),
+    ]
+    assert list(db["fetched_jobs"].rows) == [{"job_id": "x"}]
+    # Search index was rebuilt, and triggers are back in place
+    assert [r["page"] for r in db["pages"].search("two")] == [2]
+    assert {t.name for t in db["pages"].triggers} == {
+        "pages_ai",
+        "pages_ad",
+        "pages_au",
+    }
+    # Shard databases are cleaned up
+    assert os.listdir(tmpdir) == ["index.db"]
+
+
+def test_index_workers_interrupted(s3, tmpdir, mocker):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    args = ["index", "my-bucket", index_db, "--workers", "2"]
+    # Simulate the run being killed after the workers have fetched every job
+    merge_shards = mocker.patch("s3_ocr.cli.merge_shards", side_effect=OSError)
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert sqlite_utils.Database(index_db)["pages"].count == 0
+    assert sorted(os.listdir(tmpdir)) == [".s3-ocr-shards-index.db", "index.db"]
+    # The next run merges those shards, rather than fetching the jobs again
+    mocker.stop(merge_shards)
+    result = runner.invoke(cli, ["--stats"] + args, catch_exceptions=False)
+    assert result.exit_code == 0
+    assert "Merged pages fetched by an interrupted run" in result.output
+    assert "s3.GetObject" not in result.output
+    db = sqlite_utils.Database(index_db)
+    assert db["pages"].count == 3
+    assert [r["page"] for r in db["pages"].search("two")] == [2]
+    assert os.listdir(tmpdir) == ["index.db"]
+
+
+@pytest.mark.parametrize("compress", (False, True))
+def test_index_workers_incremental_keeps_fts(s3, tmpdir, mocker, compress):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    args = ["index", "my-bucket", index_db, "--workers", "2"]
+    result = runner.invoke(cli, args + (["--compress"] if compress else []))
+    assert result.exit_code == 0
+    # Adding one document does not rebuild the search index for every page
+    put_ocr_document(s3, "bar/two.pdf", "y", "Second document")
+    enable_fts = mocker.spy(sqlite_utils.db.Table, "enable_fts")
+    create_compressed_fts = mocker.spy(s3_ocr.cli, "create_compressed_fts")
+    result = runner.invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+    assert enable_fts.call_count == 0
+    assert create_compressed_fts.call_count == 0
+    index = SearchIndex(index_db)
+    assert [(r["path"], r["page"]) for r in index.search("second")] == [
+        ("bar/two.pdf", 1)
+    ]
+    assert [(r["path"], r["page"]) for r in index.search("two")] == [
+        ("foo/blah.pdf", 2)
+    ]
+
+
+@pytest.mark.parametrize("workers", ("1", "2"))
+def test_index_lines_and_words(s3, tmpdir, workers):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3)
+    bbox = {"Width": 0.5, "Height": 0.25, "Left": 0.125, "Top": 0.75}
+    s3.put_object(
+        Bucket="my-bucket",
+        Key="textract-output/x/2",
+        Body=json.dumps(
+            {
+                "Blocks": [
+                    {
+                        "Confidence": 99.5,
+                        "Text": "Hello",
+                        "BlockType": "WORD",
+                        "Page": 1,
+                        "Geometry": {"BoundingBox": bbox},
+                    },
+                    {
+                        "Confidence": 98.0,
+                        "Text": "Third line",
+                        "BlockType": "LINE",
+                        "Page": 1,
+                        "Geometry": {"BoundingBox": bbox},
+                    },
+                ]
+            }
+        ).encode("utf8"),
+    )
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["index", "my-bucket", index_db, "--lines", "--words", "--workers", workers],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(index_db)
+    assert [
+        (r["page"], r["ordinal"], r["text"], r["confidence"]) for r in db["lines"].rows
+    ] == [
+        (1, 1, "Hello there", 100),
+        (1, 2, "line 2", 100),
+        (1, 3, "Third line", 98.0),
+    ]
+    assert list(db["words"].rows) == [
+        {
+            "path": "foo/blah.pdf",
+            "page": 1,
+            "ordinal": 1,
+            "text": "Hello",
+            "confidence": 99.5,
+            "bbox": ANY,
+        }
+    ]
+    assert unpack_bbox(db["words"].get(("foo/blah.pdf", 1, 1))["bbox"]) == (
+        0.125,
+        0.75,
+        0.5,
+        0.25,
+    )
+    # Subsequent runs keep the tables up-to-date, even without the options
+    s3.delete_object(Bucket="my-bucket", Key="foo/blah.pdf.s3-ocr.json")
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    assert db["lines"].count == 0
+    assert db["words"].count == 0
+
+
+def test_stats(s3, tmpdir):
+    index_db = os.path.join(tmpdir, "index.db")
+    stats_json = os.path.join(tmpdir, "stats.json")
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["--stats", "--stats-json", stats_json, "index", "my-bucket", index_db],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert "s3.ListObjectsV2" in result.output
+    stats = json.load(open(stats_json))
+    assert stats["command"] == "index"
+    operations = stats["operations"]
+    assert operations["s3.ListObjectsV2"]["calls"] == 1
+    # One .s3-ocr.json file and one textract-output file
+    assert operations["s3.GetObject"]["calls"] == 2
+    assert operations["s3.GetObject"]["bytes_in"] > 0
+    assert operations["sqlite.replace_pages"]["calls"] == 1
+    assert operations["json.parse"]["calls"] == 1
+    assert sum(operations["json.parse"]["histogram"]) == 1
+
+
+def test_export_stats_from_threads(s3, tmpdir):
+    stats_json = os.path.join(tmpdir, "stats.json")
+    populate_ocr_results(s3)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["--stats-json", stats_json, "export", "my-bucket", "--all"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    operations = json.load(open(stats_json))["operations"]
+    # These are recorded by the threads that fetch each document
+    assert operations["json.parse"]["calls"] == 1
+    assert operations["s3.GetObject.read"]["calls"] == 1
+
+
+def test_index_incremental(s3, tmpdir):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(index_db)
+    assert db["pages"].count == 3
+    # Re-OCR under a new job that only returns a single page
+    s3.put_object(
+        Bucket="my-bucket",
+        Key="foo/blah.pdf.s3-ocr.json",
+        Body=b'{"job_id": "y", "etag": "\\"a4d0cb8bd505f67f3ea1cb5583e49550\\""}',
+    )
+    s3.put_object(
+        Bucket="my-bucket",
+        Key="textract-output/y/1",
+        Body=json.dumps(
+            {"Blocks": [{"Text": "New text", "BlockType": "LINE", "Page": 1}]}
+        ).encode("utf8"),
+    )
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    assert list(db["pages"].rows) == [
+        {"path": "foo/blah.pdf", "page": 1, "folder": "foo", "text": "New text"}
+    ]
+    assert list(db["fetched_jobs"].rows) == [{"job_id": "y"}]
+    assert [r["text"] for r in db["pages"].search("new")] == ["New text"]
+    # Deleting the .s3-ocr.json file removes the document from the index
+    s3.delete_object(Bucket="my-bucket", Key="foo/blah.pdf.s3-ocr.json")
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    assert "Removed 1 deleted document" in result.output
+    assert db["pages"].count == 0
+    assert db["ocr_jobs"].count == 0
+    assert db["fetched_jobs"].count == 0
+
+
+def test_index_duplicate_keys_share_job(s3, tmpdir):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    # A duplicate added by dedupe points at a job that was already fetched
+    s3.put_object(
+        Bucket="my-bucket",
+        Key="bar/copy.pdf.s3-ocr.json",
+        Body=b'{"job_id": "x", "etag": "\\"a4d0cb8bd505f67f3ea1cb5583e49550\\""}',
+    )
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(index_db)
+    assert [(r["path"], r["page"]) for r in db["pages"].rows] == [
+        ("foo/blah.pdf", 1),
+        ("bar/copy.pdf", 1),
+    ]
+
+
+def put_ocr_document(s3, key, job_id, text):
+    s3.put_object(
+        Bucket="my-bucket",
+        Key=key + ".s3-ocr.json",
+        Body=json.dumps({"job_id": job_id, "etag": "etag"}).encode("utf8"),
+    )
+    s3.put_object(
+        Bucket="my-bucket",
+        Key="textract-output/{}/1".format(job_id),
+        Body=json.dumps(
+            {"Blocks": [{"Text": text, "BlockType": "LINE", "Page": 1}]}
+        ).encode("utf8"),
+    )
+
+
+@pytest.mark.parametrize("workers", ("1", "2"))
+def test_index_resume(s3, tmpdir, workers):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3)
+    put_ocr_document(s3, "bar/two.pdf", "y", "Second document")
+    put_ocr_document(s3, "bar/three.pdf", "z", "Third document")
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["index", "my-bucket", index_db, "--max-jobs", "2", "--workers", workers],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert "Stopped with 1 job left to fetch - run again to continue" in result.output
+    db = sqlite_utils.Database(index_db)
+    assert db["fetched_jobs"].count == 2
+    assert db["pages"].count == 2
+    assert db["index_plan"].count == 3
+    # The next run resumes from the saved plan, without listing the bucket
+    put_ocr_document(s3, "bar/four.pdf", "w", "Fourth document")
+    result = runner.invoke(
+        cli,
+        ["--stats", "index", "my-bucket", index_db, "--workers", workers],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert "Resuming previous run" in result.output
+    assert "s3.GetObject" in result.output
+    assert "s3.ListObjectsV2" not in result.output
+    assert {r["path"] for r in db["pages"].rows} == {
+        "foo/blah.pdf",
+        "bar/two.pdf",
+        "bar/three.pdf",
+    }
+    # The plan is cleared once it has been completed
+    assert db["index_plan"].count == 0
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    assert "Resuming" not in result.output
+    assert db["pages"].count == 4
+
+
+def test_index_max_seconds_and_replan(s3, tmpdir):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["index", "my-bucket", index_db, "--max-seconds", "0"])
+    assert result.exit_code == 0
+    assert "Stopped with 1 job left to fetch" in result.output
+    db = sqlite_utils.Database(index_db)
+    assert db["pages"].count == 0
+    # --replan lists the bucket again, picking up new documents
+    put_ocr_document(s3, "bar/two.pdf", "y", "Second document")
+    result = runner.invoke(cli, ["index", "my-bucket", index_db, "--replan"])
+    assert result.exit_code == 0
+    assert "Resuming" not in result.output
+    assert db["pages"].count == 2
+    assert db["index_plan"].count == 0
+
+
+@pytest.mark.parametrize("workers", ("1", "2"))
+def test_index_resume_skips_missing_output(s3, tmpdir, workers):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3)
+    put_ocr_document(s3, "bar/two.pdf", "y", "Second document")
+    runner = CliRunner()
+    result = runner.invoke(cli, ["index", "my-bucket", index_db, "--max-jobs", "0"])
+    assert result.exit_code == 0
+    # The document is deleted from the bucket after the plan was saved
+    s3.delete_object(Bucket="my-bucket", Key="bar/two.pdf.s3-ocr.json")
+    s3.delete_object(Bucket="my-bucket", Key="textract-output/y/1")
+    result = runner.invoke(cli, ["index", "my-bucket", index_db, "--workers", workers])
+    assert result.exit_code == 0
+    assert "Skipped job y: its OCR results are no longer in the bucket" in (
+        result.output
+    )
+    db = sqlite_utils.Database(index_db)
+    assert [r["path"] for r in db["pages"].rows] == ["foo/blah.pdf"]
+    assert db["index_plan"].count == 0
+    # The next run lists the bucket, and removes the deleted document
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    assert "Removed 1 deleted document" in result.output
+
+
+def test_index_max_seconds_includes_listing(s3, tmpdir, mocker):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3)
+    plan_index = s3_ocr.cli.plan_index
+
+    def slow_plan_index(*args):
+        plan_index(*args)
+        time.sleep(0.2)
+
+    mocker.patch("s3_ocr.cli.plan_index", side_effect=slow_plan_index)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["index", "my-bucket", index_db, "--max-seconds", "0.1"]
+    )
+    assert result.exit_code == 0
+    assert "Stopped with 1 job left to fetch" in result.output
+    assert sqlite_utils.Database(index_db)["pages"].count == 0
+
+
 @pytest.mark.parametrize("combine", (None, "-", "output.json"))
 def test_fetch(s3, combine):
     populate_ocr_results(s3)
@@ -203,6 +604,83 @@ def test_text(s3, divider):
             )
 
 
+EXPECTED_EXPORT_JSONL = [
+    {"path": "foo/blah.pdf", "page": 1, "text": "Hello there\nline 2"},
+    {"path": "foo/blah.pdf", "page": 2, "text": "Page two\nLine 2 of page 2"},
+    {"path": "foo/blah.pdf", "page": 3, "text": ""},
+]
+
+
+@pytest.mark.parametrize("use_database", (False, True))
+@pytest.mark.parametrize("args", (["--all"], ["--prefix", "foo/"], ["foo/blah.pdf"]))
+def test_export_jsonl(s3, tmpdir, use_database, args):
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    extra = []
+    if use_database:
+        index_db = os.path.join(tmpdir, "index.db")
+        result = runner.invoke(cli, ["index", "my-bucket", index_db])
+        assert result.exit_code == 0
+        extra = ["--database", index_db]
+    result = runner.invoke(
+        cli,
+        ["export", "my-bucket", "--format", "jsonl"] + args + extra,
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    lines = result.output.strip().split("\n")
+    assert [json.loads(line) for line in lines] == EXPECTED_EXPORT_JSONL
+
+
+@pytest.mark.parametrize("divider", (True, False))
+def test_export_text(s3, divider):
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    args = ["export", "my-bucket", "foo/blah.pdf", "missing.pdf"]
+    if divider:
+        args.append("--divider")
+    result = runner.invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+    warning = "No OCR results for key: missing.pdf\n"
+    assert warning in result.output
+    separator = "\n\n----\n\n" if divider else "\n\n\n"
+    assert result.output.replace(warning, "") == (
+        "==> foo/blah.pdf <==\n"
+        "Hello there\nline 2" + separator + "Page two\nLine 2 of page 2" + "\n\n"
+    )
+    # Matches the output of the text command for the same document
+    text_args = ["text", "my-bucket", "foo/blah.pdf"]
+    if divider:
+        text_args.append("--divider")
+    text_output = runner.invoke(cli, text_args).output
+    assert result.output.replace(warning, "") == (
+        "==> foo/blah.pdf <==\n" + text_output + "\n"
+    )
+
+
+def test_export_requires_keys(s3):
+    result = CliRunner().invoke(cli, ["export", "my-bucket"])
+    assert result.exit_code == 1
+    assert "Specify keys, --prefix or use --all" in result.output
+
+
+def test_assemble_pages():
+    pages = {}
+    page_numbers = set()
+    blocks = [
+        {"BlockType": "PAGE", "Page": 1},
+        {"BlockType": "LINE", "Page": 1, "Text": "One"},
+        {"BlockType": "WORD", "Page": 1, "Text": "One"},
+        {"BlockType": "PAGE", "Page": 2},
+        {"BlockType": "LINE", "Page": 3, "Text": "Three"},
+    ]
+    assemble_pages(blocks, pages, page_numbers)
+    # A second output file for the same job can continue an earlier page
+    assemble_pages([{"BlockType": "LINE", "Page": 1, "Text": "Two"}], pages)
+    assert pages == {1: ["One", "Two"], 3: ["Three"]}
+    assert page_numbers == {1, 2}
+
+
 def populate_ocr_results(s3, multi_page=False):
     for name, content in (
         ("foo/blah.pdf", b"Predictable ETag"),
@@ -325,3 +803,529 @@ def test_limit_exceeded_automatic_retry(s3, mocker):
         "Starting OCR for blah.pdf, Job ID: 123\n"
     )
     assert_expected_contents_after_all(s3)
+
+
+def make_pdf(pages):
+    pypdf = pytest.importorskip("pypdf")
+    import io
+
+    writer = pypdf.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=72, height=72)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def test_start_split_pages(s3, mocker):
+    s3.put_object(Bucket="my-bucket", Key="big.pdf", Body=make_pdf(5))
+    s3.put_object(Bucket="my-bucket", Key="small.pdf", Body=make_pdf(2))
+    mocked = mocker.patch("s3_ocr.cli.start_document_text_extraction")
+    mocked.side_effect = [{"JobId": "j{}".format(i)} for i in range(1, 6)]
+    runner = CliRunner()
+    args = ["start", "my-bucket", "--all", "--split-pages", "2"]
+    result = runner.invoke(cli, args + ["--split-min-bytes", "0"])
+    assert result.exit_code == 0, result.output
+    assert result.output == (
+        "Found 0 files with .s3-ocr.json out of 3 PDFs\n"
+        "Starting OCR for big.pdf from page 1, Job ID: j1\n"
+        "Starting OCR for big.pdf from page 3, Job ID: j2\n"
+        "Starting OCR for big.pdf from page 5, Job ID: j3\n"
+        # blah.pdf is not a valid PDF, so it is submitted as it is
+        "Starting OCR for blah.pdf, Job ID: j4\n"
+        "Starting OCR for small.pdf, Job ID: j5\n"
+    )
+    submitted = [
+        call.kwargs["DocumentLocation"]["S3Object"]["Name"]
+        for call in mocked.call_args_list
+    ]
+    assert submitted == [
+        "s3-ocr-chunks/big.pdf/pages-000001-000002.pdf",
+        "s3-ocr-chunks/big.pdf/pages-000003-000004.pdf",
+        "s3-ocr-chunks/big.pdf/pages-000005-000005.pdf",
+        "blah.pdf",
+        "small.pdf",
+    ]
+    marker = json.loads(
+        s3.get_object(Bucket="my-bucket", Key="big.pdf.s3-ocr.json")["Body"].read()
+    )
+    assert marker == {
+        "job_id": "j1",
+        "etag": ANY,
+        "chunks": [
+            {"job_id": "j1", "offset": 0},
+            {"job_id": "j2", "offset": 2},
+            {"job_id": "j3", "offset": 4},
+        ],
+    }
+    small_marker = json.loads(
+        s3.get_object(Bucket="my-bucket", Key="small.pdf.s3-ocr.json")["Body"].read()
+    )
+    assert set(small_marker.keys()) == {"job_id", "etag"}
+    # Running it again should not submit the chunks as new PDFs
+    result = runner.invoke(cli, ["start", "my-bucket", "--all", "--dry-run"])
+    assert result.output == (
+        "Found 3 files with .s3-ocr.json out of 3 PDFs\n"
+        "Would start 0 tasks for these keys:\n"
+    )
+
+
+def test_start_split_pages_min_bytes(s3, mocker):
+    s3.put_object(Bucket="my-bucket", Key="big.pdf", Body=make_pdf(5))
+    s3.put_object(Bucket="my-bucket", Key="small.pdf", Body=make_pdf(2))
+    threshold = str(len(make_pdf(4)))
+    runner = CliRunner()
+    args = ["start", "my-bucket", "--all", "--split-pages", "2"]
+    args += ["--split-min-bytes", threshold]
+    result = runner.invoke(cli, args + ["--dry-run"])
+    assert result.exit_code == 0, result.output
+    assert result.output == (
+        "Found 0 files with .s3-ocr.json out of 3 PDFs\n"
+        "Would start 3 tasks for these keys:\n"
+        "big.pdf (split if it has more than 2 pages)\n"
+        "blah.pdf\n"
+        "small.pdf\n"
+    )
+    # Only big.pdf is downloaded to count its pages
+    download = mocker.spy(s3_ocr.cli, "split_pdf")
+    mocked = mocker.patch("s3_ocr.cli.start_document_text_extraction")
+    mocked.side_effect = [{"JobId": "j{}".format(i)} for i in range(1, 6)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert [call.args[2] for call in download.call_args_list] == ["big.pdf"]
+    assert len(mocked.call_args_list) == 5
+
+
+def populate_chunked_ocr_results(s3, chunk_jobs):
+    s3.put_object(Bucket="my-bucket", Key="big.pdf", Body=b"Big PDF")
+    s3.put_object(
+        Bucket="my-bucket",
+        Key="big.pdf.s3-ocr.json",
+        Body=json.dumps(
+            {
+                "job_id": "j1",
+                "etag": "etag",
+                "chunks": [
+                    {"job_id": "j1", "offset": 0},
+                    {"job_id": "j2", "offset": 2},
+                ],
+            }
+        ),
+    )
+    for name in ("pages-000001-000002.pdf", "pages-000003-000004.pdf"):
+        s3.put_object(
+            Bucket="my-bucket", Key="s3-ocr-chunks/big.pdf/" + name, Body=b"Chunk"
+        )
+    for job_id in chunk_jobs:
+        blocks = []
+        for page in (1, 2):
+            blocks.append({"BlockType": "PAGE", "Page": page})
+            blocks.append(
+                {
+                    "BlockType": "LINE",
+                    "Page": page,
+                    "Text": "{} page {}".format(job_id, page),
+                }
+            )
+        s3.put_object(
+            Bucket="my-bucket",
+            Key="textract-output/{}/1".format(job_id),
+            Body=json.dumps({"Blocks": blocks}),
+        )
+
+
+def test_split_pages_text_and_fetch(s3, tmpdir):
+    populate_chunked_ocr_results(s3, ["j1", "j2"])
+    runner = CliRunner()
+    result = runner.invoke(cli, ["text", "my-bucket", "big.pdf"])
+    assert result.exit_code == 0
+    assert result.output == "j1 page 1\n\n\nj1 page 2\n\n\nj2 page 1\n\n\nj2 page 2\n"
+    combined = os.path.join(tmpdir, "combined.json")
+    result = runner.invoke(
+        cli, ["fetch", "my-bucket", "big.pdf", "--combine", combined]
+    )
+    assert result.exit_code == 0
+    with open(combined) as fp:
+        blocks = json.load(fp)["Blocks"]
+    assert [(b["Page"], b["Text"]) for b in blocks if b["BlockType"] == "LINE"] == [
+        (1, "j1 page 1"),
+        (2, "j1 page 2"),
+        (3, "j2 page 1"),
+        (4, "j2 page 2"),
+    ]
+    # Without --combine each file is saved with the adjusted page numbers
+    with runner.isolated_filesystem():
+        result = runner.invoke(cli, ["fetch", "my-bucket", "big.pdf"])
+        assert result.exit_code == 0
+        pages = {}
+        for filename in ("j1-1.json", "j2-1.json"):
+            with open(filename) as fp:
+                pages[filename] = [b["Page"] for b in json.load(fp)["Blocks"]]
+    assert pages == {"j1-1.json": [1, 1, 2, 2], "j2-1.json": [3, 3, 4, 4]}
+
+
+@pytest.mark.parametrize(
+    "chunk_jobs,expected", (([], 0), (["j1"], 0), (["j1", "j2"], 1))
+)
+def test_split_pages_status(s3, chunk_jobs, expected):
+    populate_chunked_ocr_results(s3, chunk_jobs)
+    populate_ocr_results(s3)
+    result = CliRunner().invoke(cli, ["status", "my-bucket"])
+    assert result.exit_code == 0
+    assert result.output == "{} complete out of 2 jobs\n".format(expected + 1)
+
+
+@pytest.mark.parametrize("workers", ("1", "2"))
+def test_split_pages_index(s3, tmpdir, workers):
+    index_db = os.path.join(tmpdir, "index.db")
+    # Only the first chunk has finished
+    populate_chunked_ocr_results(s3, ["j1"])
+    runner = CliRunner()
+    args = ["index", "my-bucket", index_db, "--workers", workers]
+    result = runner.invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(index_db)
+    assert db["pages"].count == 0
+    assert db["fetched_jobs"].count == 0
+    # Now the second chunk is ready too
+    populate_chunked_ocr_results(s3, ["j2"])
+    result = runner.invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+    assert [(r["page"], r["text"]) for r in db["pages"].rows] == [
+        (1, "j1 page 1"),
+        (2, "j1 page 2"),
+        (3, "j2 page 1"),
+        (4, "j2 page 2"),
+    ]
+    assert list(db["fetched_jobs"].rows) == [{"job_id": "j1"}]
+
+
+@pytest.mark.parametrize(
+    "options,expected",
+    (
+        ([], ["big.pdf", "blah.pdf", "urgent/large.pdf", "urgent/small.pdf"]),
+        (
+            ["--order", "smallest"],
+            ["blah.pdf", "urgent/small.pdf", "big.pdf", "urgent/large.pdf"],
+        ),
+        (
+            ["--order", "largest"],
+            ["urgent/large.pdf", "big.pdf", "urgent/small.pdf", "blah.pdf"],
+        ),
+        (
+            ["--priority-prefix", "urgent/", "--order", "smallest"],
+            ["urgent/small.pdf", "urgent/large.pdf", "blah.pdf", "big.pdf"],
+        ),
+        (
+            ["--priority-prefix", "urgent/small", "--priority-prefix", "big"],
+            ["urgent/small.pdf", "big.pdf", "blah.pdf", "urgent/large.pdf"],
+        ),
+    ),
+)
+def test_start_order(s3, options, expected):
+    s3.put_object(Bucket="my-bucket", Key="big.pdf", Body=b"x" * 100)
+    s3.put_object(Bucket="my-bucket", Key="urgent/small.pdf", Body=b"x" * 10)
+    s3.put_object(Bucket="my-bucket", Key="urgent/large.pdf", Body=b"x" * 1000)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["start", "my-bucket", "--all", "--dry-run"] + options)
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines()[2:] == expected
+
+
+def test_schedule_by_last_modified():
+    items = [
+        {"Key": "b.pdf", "LastModified": datetime.datetime(2022, 1, 2)},
+        {"Key": "a.pdf", "LastModified": datetime.datetime(2022, 1, 1)},
+        {"Key": "c.pdf", "LastModified": datetime.datetime(2022, 1, 3)},
+    ]
+    assert [item["Key"] for item in schedule(items, "newest")] == [
+        "c.pdf",
+        "b.pdf",
+        "a.pdf",
+    ]
+    assert [item["Key"] for item in schedule(items, "oldest")] == [
+        "a.pdf",
+        "b.pdf",
+        "c.pdf",
+    ]
+
+
+def test_start_max_in_flight(s3, mocker):
+    s3.put_object(Bucket="my-bucket", Key="blah2.pdf", Body=b"Fake PDF")
+    s3.put_object(Bucket="my-bucket", Key="blah3.pdf", Body=b"Fake PDF")
+    started = mocker.patch("s3_ocr.cli.start_document_text_extraction")
+    started.side_effect = [{"JobId": "j1"}, {"JobId": "j2"}, {"JobId": "j3"}]
+    get_job_status = mocker.patch("s3_ocr.cli.get_job_status")
+    get_job_status.side_effect = ["IN_PROGRESS", "SUCCEEDED", "FAILED"]
+    sleep = mocker.patch("s3_ocr.cli.time.sleep")
+    runner = CliRunner()
+    result = runner.invoke(cli, ["start", "my-bucket", "--all", "--max-in-flight", "1"])
+    assert result.exit_code == 0, result.output
+    assert result.output == (
+        "Found 0 files with .s3-ocr.json out of 3 PDFs\n"
+        "Starting OCR for blah.pdf, Job ID: j1\n"
+        "Waiting for some of 1 running jobs to finish...\n"
+        "Starting OCR for blah2.pdf, Job ID: j2\n"
+        "Starting OCR for blah3.pdf, Job ID: j3\n"
+    )
+    assert [call.args[1] for call in get_job_status.call_args_list] == [
+        "j1",
+        "j1",
+        "j2",
+    ]
+    sleep.assert_called_once_with(1)
+
+
+def test_start_max_bytes_in_flight(s3, mocker):
+    # blah.pdf is 8 bytes
+    s3.put_object(Bucket="my-bucket", Key="small.pdf", Body=b"x" * 2)
+    s3.put_object(Bucket="my-bucket", Key="huge.pdf", Body=b"x" * 100)
+    started = mocker.patch("s3_ocr.cli.start_document_text_extraction")
+    started.side_effect = [{"JobId": "j1"}, {"JobId": "j2"}, {"JobId": "j3"}]
+    get_job_status = mocker.patch("s3_ocr.cli.get_job_status")
+    get_job_status.side_effect = ["SUCCEEDED", "SUCCEEDED"]
+    mocker.patch("s3_ocr.cli.time.sleep")
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["start", "my-bucket", "--all", "--order", "smallest"]
+        + ["--max-bytes-in-flight", "10"],
+    )
+    assert result.exit_code == 0, result.output
+    # small.pdf and blah.pdf fit together, huge.pdf waits for both to finish
+    assert [call.args[1] for call in get_job_status.call_args_list] == ["j1", "j2"]
+
+
+@pytest.fixture
+def search_db(tmpdir):
+    path = str(tmpdir / "index.db")
+    db = sqlite_utils.Database(path)
+    db["pages"].insert_all(
+        [
+            {
+                "path": "reports/2021/a.pdf",
+                "page": 1,
+                "folder": "reports/2021",
+                "text": "The climate report for 2021",
+            },
+            {
+                "path": "reports/b.pdf",
+                "page": 1,
+                "folder": "reports",
+                "text": "Climate climate climate change",
+            },
+            {
+                "path": "reports/b.pdf",
+                "page": 2,
+                "folder": "reports",
+                "text": "Nothing to see here",
+            },
+            {
+                "path": "reports-old/c.pdf",
+                "page": 3,
+                "folder": "reports-old",
+                "text": "An old climate-related memo",
+            },
+        ],
+        pk=("path", "page"),
+    )
+    db["pages"].enable_fts(["text"], create_triggers=True)
+    return path
+
+
+def test_search_index(search_db):
+    index = SearchIndex(search_db)
+    results = index.search("climate")
+    assert [(r["path"], r["page"]) for r in results] == [
+        ("reports/b.pdf", 1),
+        ("reports/2021/a.pdf", 1),
+        ("reports-old/c.pdf", 3),
+    ]
+    assert results[0]["snippet"] == "[Climate] [climate] [climate] change"
+    assert results[0]["folder"] == "reports"
+    assert isinstance(results[0]["rank"], float)
+    assert index.count("climate") == 3
+    # Folder filter includes nested folders, but not folders with that prefix
+    assert [r["path"] for r in index.search("climate", folder="reports")] == [
+        "reports/b.pdf",
+        "reports/2021/a.pdf",
+    ]
+    assert index.count("climate", folder="reports") == 2
+    # A trailing slash is ignored, like in a --prefix
+    assert [r["path"] for r in index.search("climate", folder="reports/")] == [
+        "reports/b.pdf",
+        "reports/2021/a.pdf",
+    ]
+    assert index.count("climate", folder="reports/") == 2
+    # Pagination
+    assert [r["path"] for r in index.search("climate", limit=1, offset=1)] == [
+        "reports/2021/a.pdf"
+    ]
+    # FTS5 syntax characters are treated as part of the words
+    assert [r["path"] for r in index.search("climate-related")] == ["reports-old/c.pdf"]
+    assert index.search("") == []
+    assert [r["page"] for r in index.search("climate NOT change", raw=True)] == [1, 3]
+    assert index.page_text("reports/b.pdf", 2) == "Nothing to see here"
+    assert index.page_text("reports/b.pdf", 5) is None
+    index.close()
+
+
+def test_search_index_cache_and_threads(search_db):
+    index = SearchIndex(search_db, cache_size=10)
+    assert len(index.search("climate")) == 3
+    sqlite_utils.Database(search_db)["pages"].delete(("reports/b.pdf", 1))
+    # Cached until the cache is cleared
+    assert len(index.search("climate")) == 3
+    index.clear_cache()
+    assert len(index.search("climate")) == 2
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        counts = list(executor.map(lambda q: index.count(q), ["climate"] * 20))
+    assert counts == [2] * 20
+    # Each thread used its own connection
+    assert 1 < len(index._connections) <= 5
+    index.close()
+    assert index._connections == []
+
+
+@pytest.mark.parametrize("folder", ("reports", "reports/"))
+def test_search_command(search_db, folder):
+    runner = CliRunner()
+    result = runner.invoke(cli, ["search", search_db, "climate", "--folder", folder])
+    assert result.exit_code == 0
+    assert result.output == (
+        "reports/b.pdf (page 1)\n"
+        "    [Climate] [climate] [climate] change\n"
+        "reports/2021/a.pdf (page 1)\n"
+        "    The [climate] report for 2021\n"
+    )
+    result = runner.invoke(cli, ["search", search_db, "change", "--json"])
+    assert result.exit_code == 0
+    assert json.loads(result.output) == [
+        {
+            "path": "reports/b.pdf",
+            "page": 1,
+            "folder": "reports",
+            "snippet": "Climate climate climate [change]",
+            "rank": ANY,
+        }
+    ]
+    result = runner.invoke(cli, ["search", search_db, "climate AND", "--raw"])
+    assert result.exit_code == 1
+    assert "Error: fts5: syntax error" in result.output
+
+
+def test_text_codec():
+    texts = ["the quick brown fox", "the lazy dog and the fox", "the end"]
+    zdict = build_zdict(texts)
+    # Most common words go at the end of the dictionary
+    assert zdict.endswith(b"the ")
+    assert b"quick" not in zdict
+    codec = TextCodec(zdict)
+    compressed = codec.compress("the quick brown fox")
+    assert isinstance(compressed, bytes)
+    assert codec.decompress(compressed) == "the quick brown fox"
+    # Uncompressed values are returned unchanged
+    assert codec.decompress("plain") == "plain"
+    assert codec.decompress(None) is None
+
+
+@pytest.mark.parametrize("workers", ("1", "2"))
+def test_index_compress(s3, tmpdir, workers):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["index", "my-bucket", index_db, "--compress", "--workers", workers],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert_compressed_index(index_db)
+    # Later runs keep compressing, and the search index follows deletions
+    s3.put_object(Bucket="my-bucket", Key="bar/new.pdf", Body=b"New PDF")
+    s3.put_object(
+        Bucket="my-bucket",
+        Key="bar/new.pdf.s3-ocr.json",
+        Body=json.dumps({"job_id": "y", "etag": "etag"}),
+    )
+    s3.put_object(
+        Bucket="my-bucket",
+        Key="textract-output/y/1",
+        Body=json.dumps(
+            {"Blocks": [{"BlockType": "LINE", "Page": 1, "Text": "Hello again"}]}
+        ),
+    )
+    s3.delete_object(Bucket="my-bucket", Key="foo/blah.pdf.s3-ocr.json")
+    result = runner.invoke(cli, ["index", "my-bucket", index_db, "--workers", workers])
+    assert result.exit_code == 0
+    index = SearchIndex(index_db)
+    assert [(r["path"], r["snippet"]) for r in index.search("hello")] == [
+        ("bar/new.pdf", "[Hello] again")
+    ]
+    assert isinstance(
+        sqlite_utils.Database(index_db).execute("SELECT text FROM pages").fetchone()[0],
+        bytes,
+    )
+    index.close()
+
+
+def test_index_compress_existing_database(s3, tmpdir):
+    index_db = os.path.join(tmpdir, "index.db")
+    populate_ocr_results(s3, multi_page=True)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    assert isinstance(
+        sqlite_utils.Database(index_db).execute("SELECT text FROM pages").fetchone()[0],
+        str,
+    )
+    result = runner.invoke(cli, ["index", "my-bucket", index_db, "--compress"])
+    assert result.exit_code == 0
+    assert_compressed_index(index_db)
+
+
+def test_index_ignores_unrelated_settings_tables(s3, tmpdir):
+    index_db = os.path.join(tmpdir, "index.db")
+    db = sqlite_utils.Database(index_db)
+    # Tables that happen to use the same name are not mistaken for ours
+    db["settings"].insert({"name": "theme", "v": "dark"})
+    db["s3_ocr_settings"].insert({"name": "theme", "v": "dark"})
+    populate_ocr_results(s3)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["index", "my-bucket", index_db])
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ["export", "my-bucket", "--all", "-d", index_db])
+    assert result.exit_code == 0
+    assert "Hello there" in result.output
+    assert [r["path"] for r in SearchIndex(index_db).search("hello")] == [
+        "foo/blah.pdf"
+    ]
+
+
+def assert_compressed_index(index_db):
+    db = sqlite_utils.Database(index_db)
+    assert db["s3_ocr_settings"].get("zdict")["value"]
+    assert {type(row["text"]) for row in db["pages"].rows} == {bytes}
+    # The search index does not store its own copy of the text
+    assert not db["pages_fts_content"].exists()
+    assert {t.name for t in db["pages"].triggers} == {
+        "pages_ai",
+        "pages_ad",
+        "pages_au",
+    }
+    index = SearchIndex(index_db)
+    results = index.search("two")
+    assert [(r["path"], r["page"], r["snippet"]) for r in results] == [
+        ("foo/blah.pdf", 2, "Page [two]\nLine 2 of page 2")
+    ]
+    assert index.page_text("foo/blah.pdf", 1) == "Hello there\nline 2"
+    index.close()
+    result = CliRunner().invoke(
+        cli,
+        ["export", "my-bucket", "--all", "--database", index_db, "--format", "jsonl"],
+    )
+    assert [json.loads(line)["text"] for line in result.output.splitlines()] == [
+        "Hello there\nline 2",
+        "Page two\nLine 2 of page 2",
+        "",
+    ]